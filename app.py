@@ -1,10 +1,22 @@
+import hmac
 import os
-from flask import Flask, session, render_template, request, redirect, url_for, jsonify, flash
-from sqlalchemy.exc import DataError
-from models import db, connect_db, Repo, Entry
+import time
+import click
+from flask import Flask, session, render_template, request, redirect, url_for, jsonify, flash, json, stream_with_context
+from flask_migrate import Migrate
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+from models import db, connect_db, Repo, Entry, ScrapeCache, ScrapeJob
 from forms import AuthRepoForm, NewRepoForm
-from scrape import get_tags
-from datetime import timedelta
+from scrape import get_tags, get_tags_batch, job_url, tag_cache, pool_stats
+from cache import TieredCache, DiskStore
+from visits import visit_tracker
+import exports
+import imports
+import hashing
+import instrumentation
+import metrics
+import profiling
+from datetime import date, datetime, timedelta
 
 app = Flask(__name__)
 
@@ -17,10 +29,51 @@ app.config['SQLALCHEMY_DATABASE_URI'] = (
 )
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    # Per process. Size it for the request threads (GUNICORN_THREADS) plus the scrape pool's cache lookups
+    'pool_size' : int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow' : int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    # Seconds a request waits for a free connection before failing, rather than hanging with the pool exhausted
+    'pool_timeout' : float(os.environ.get('DB_POOL_TIMEOUT', 10)),
+    # Checks connections before use and replaces those dropped by a database restart
+    'pool_pre_ping' : os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    'pool_recycle' : int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    # Postgres cancels any statement running longer than this many milliseconds (0 for no limit)
+    'connect_args' : {'options' : f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT', 15000))}"}
+}
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
+app.config['SCRAPE_BATCH_LIMIT'] = int(os.environ.get('SCRAPE_BATCH_LIMIT', 200))
+# When enabled, scrapes missing from the cache are handed to worker.py instead of being fetched inside the request
+app.config['SCRAPE_JOBS'] = os.environ.get('SCRAPE_JOBS', '1') == '1'
+app.config['ENTRIES_PAGE_LIMIT'] = int(os.environ.get('ENTRIES_PAGE_LIMIT', 500))
+app.config['IMPORT_MAX_ENTRIES'] = int(os.environ.get('IMPORT_MAX_ENTRIES', 50000))
+app.config['IMPORT_BATCH_SIZE'] = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+# Seconds an import may spend scraping links inline (enrich=1 without scrape jobs), across all of its batches
+app.config['IMPORT_ENRICH_DEADLINE'] = float(os.environ.get('IMPORT_ENRICH_DEADLINE', 20))
+app.config['RESPONSE_CACHE_SIZE'] = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+app.config['RESPONSE_CACHE_TTL'] = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))
+# Optional directory for a response cache shared by every worker process on the machine
+app.config['RESPONSE_CACHE_DIR'] = os.environ.get('RESPONSE_CACHE_DIR')
+# When set, /metrics requires an 'Authorization: Bearer <token>' header
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 
 connect_db(app)
-db.create_all()
+# Schema changes are made with migrations, run `flask db upgrade` to create or update the database
+migrate = Migrate(app, db)
+
+# Share scraped metadata between worker processes through the database
+tag_cache.store = ScrapeCache
+
+# Rendered JSON and HTML of public repos, see cached_repo_payload
+response_cache = TieredCache(
+    app.config['RESPONSE_CACHE_SIZE'],
+    store=DiskStore(app.config['RESPONSE_CACHE_DIR']) if app.config['RESPONSE_CACHE_DIR'] else None
+)
+
+instrumentation.init_app(
+    app, caches={'response' : response_cache, 'tag' : tag_cache}, visit_tracker=visit_tracker, pool_stats=pool_stats
+)
+profiling.init_app(app)
 
 @app.before_request
 def before_request_func():
@@ -56,9 +109,17 @@ def repo_view(access_key):
     if repo.is_private and ('working_repo' not in session or session['working_repo'] != access_key):
         return redirect(url_for('repo_auth', access_key=access_key))
     else:
-        repo.update_last_visited()
+        # Written in bulk later, so a page view doesn't lock and write the repo's row
+        visit_tracker.record(access_key, repo.last_visited)
         session['last_viewed'] = repo.access_key
-        return render_template('repo.html', repo=repo)
+        if session.get('working_repo') == access_key:
+            # The editor's page carries the edit forms, so it's never shared
+            return render_template('repo.html', repo=repo)
+
+        html, hit = cached_repo_payload('html', access_key, repo_etag(repo), lambda: render_template('repo.html', repo=repo))
+        res = app.response_class(html, mimetype='text/html')
+        res.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+        return res
 
 @app.route('/repo/auth', methods=['GET', 'POST'])
 def repo_auth():
@@ -70,7 +131,7 @@ def repo_auth():
         return redirect(url_for('repo_view', access_key=repo.access_key))
 
     if form.validate_on_submit():
-        if Repo.authenticate(repo.access_key, form.pass_phrase.data):
+        if repo_authenticate(repo, form.pass_phrase.data):
             session['working_repo'] = repo.access_key
             session.permanent = True
             return redirect(url_for('repo_view', access_key=repo.access_key))
@@ -84,36 +145,80 @@ def repo_auth():
 
 @app.route('/api/scrape')
 def api_scrape_url():
-    """ API Route for retrieving OpenGraph meta-data on a given URL in the query string. The route requires authentication. """
-    if 'working_repo' in session:
-        meta_data = get_tags(request.args['url'])
+    """ API Route for retrieving OpenGraph meta-data on a given URL in the query string. The route requires authentication.
+    Cached meta-data is returned right away. Otherwise, if scrape jobs are enabled, the URL is queued for the background
+    worker and the response is a 202 with the job, to be polled at /api/scrape/jobs/<id>. Equivalent URLs share a job. """
+    if 'working_repo' not in session:
+        return jsonify(msg="failure, unauthorized"), 401
+
+    url = request.args['url']
+    if not app.config['SCRAPE_JOBS']:
+        return jsonify(msg="success", data=get_tags(url))
+
+    meta_data = get_tags(url, fetch=False)
+    if meta_data is not None:
         return jsonify(msg="success", data=meta_data)
-    else:
+
+    job = ScrapeJob.enqueue(job_url(url))
+    db.session.commit()
+    return jsonify(msg="queued", job=job.to_json()), 202
+
+@app.route('/api/scrape/jobs/<int:job_id>')
+def api_scrape_job(job_id):
+    """ API Route for polling a queued scrape, requires authentication. Responds right away with the job's current status,
+    so a poll never holds a web worker; clients back off between polls. """
+    if 'working_repo' not in session:
         return jsonify(msg="failure, unauthorized"), 401
 
+    job = ScrapeJob.query.get(job_id)
+    if not job:
+        return jsonify(error="Job not found"), 404
+
+    return jsonify(job.to_json())
+
+@app.route('/api/scrape/batch', methods=['POST'])
+def api_scrape_batch():
+    """ API Route for retrieving OpenGraph meta-data on many URLs at once, fetched concurrently. The route requires authentication.
+    Incoming JSON Schema:
+    { 'urls' : [String, String, ...] }
+    Response data holds one result per URL, in the same order: {'url' : String, 'data' : {meta_data}} or {'url' : String, 'error' : String}
+    """
+    if 'working_repo' not in session:
+        return jsonify(msg="failure, unauthorized"), 401
+
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('urls'), list):
+        return jsonify(error="Bad request, field 'urls' must be a list"), 400
+    urls = data['urls']
+    if not all(isinstance(url, str) and url for url in urls):
+        return jsonify(error="Bad request, each url must be a non-empty string"), 400
+    if len(urls) > app.config['SCRAPE_BATCH_LIMIT']:
+        return jsonify(error=f"Bad request, at most {app.config['SCRAPE_BATCH_LIMIT']} urls per batch"), 400
+
+    return jsonify(msg="success", data=get_tags_batch(urls))
+
 @app.route('/api/repo/create', methods=['POST'])
 def api_repo_create():
     """ API Route for creating a new repository. This route uses request form data and WTForms CSRF validation."""
     form = NewRepoForm()
     if form.validate_on_submit():
-        # On the miniscule chance we generate a non-unique access key, loop and try again.
-        success = False
-        while not success:
-            new_repo = Repo.create(
-                pass_phrase = form.pass_phrase.data,
-                title = form.title.data,
-                description = form.description.data,
-                is_private = form.is_private.data
-            )
-            db.session.add(new_repo)
-            try:
-                db.session.commit()
-                success = True
-            except:
-                db.session.rollback()
-                success = False
-        session['working_repo'] = new_repo.access_key
-        return jsonify(message='success', created=new_repo.access_key)
+        created = Repo.insert_new(
+            pass_phrase = form.pass_phrase.data,
+            title = form.title.data,
+            description = form.description.data,
+            is_private = form.is_private.data
+        )
+        # Only if every freshly drawn key was already taken, which at the default key length is practically never
+        if not created:
+            db.session.rollback()
+            return jsonify(message="failed", error="Could not generate a unique access key, please try again"), 500
+        db.session.commit()
+
+        session['working_repo'] = created.access_key
+        session['auth_proof'] = hashing.make_proof(
+            app.config['SECRET_KEY'], created.access_key, created.pass_phrase, form.pass_phrase.data
+        )
+        return jsonify(message='success', created=created.access_key)
     else:
         return jsonify(message="failed", errors=form.errors_to_json()), 400
 
@@ -121,25 +226,89 @@ def api_repo_create():
 @app.route('/api/repo/<access_key>', methods=['GET'])
 def api_repo_get(access_key):
     """ API Route for retrieving a repo's JSON-serialized data. If the repo is flagged as private,
-    requesting client must be authenticated in the session."""
+    requesting client must be authenticated in the session.
+    With a 'summary' query parameter, entries are left out in favour of an 'entry_count', for clients that page through
+    them at /api/repo/<access_key>/entries.
+    Responses carry an ETag, and a request whose If-None-Match holds the current one gets an empty 304, checked with a
+    query of just the repo's revision columns, before any entries are loaded."""
+    revision, error = api_repo_readable(access_key)
+    if error:
+        return jsonify(error=error['error']), error['code']
+
+    summary = 'summary' in request.args
+    return repo_json_response(
+        access_key, revision, repo_etag(revision),
+        lambda: json.dumps(Repo.query.get(access_key).to_json(summary=summary)),
+        cache_kind='summary' if summary else 'json'
+    )
+
+@app.route('/api/repo/<access_key>/entries', methods=['GET'])
+def api_repo_entries(access_key):
+    """ API Route for paging through a repo's entries in sequence order, with the same access rules as GET /api/repo/<access_key>.
+    Query string: 'limit', entries per page (at most, and by default, ENTRIES_PAGE_LIMIT) and 'after', the 'next' cursor
+    of the previous page. Response JSON Schema:
+    { 'entries' : [ {entry_data}, ...], 'next' : String, or null on the last page }
+    """
+    revision, error = api_repo_readable(access_key)
+    if error:
+        return jsonify(error=error['error']), error['code']
+
+    try:
+        limit = int(request.args.get('limit', app.config['ENTRIES_PAGE_LIMIT']))
+        after = parse_entries_cursor(request.args['after']) if 'after' in request.args else None
+        if limit < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify(error="Bad request, 'limit' must be a positive integer and 'after' a cursor from a previous page"), 400
+    limit = min(limit, app.config['ENTRIES_PAGE_LIMIT'])
+
+    def render():
+        # One extra row tells whether there's a next page
+        entries = Entry.json_for_repo(access_key, after=after, limit=limit + 1)
+        next = entries_cursor(entries[limit - 1]) if len(entries) > limit else None
+        return json.dumps({'entries' : entries[:limit], 'next' : next})
+
+    # A page is fully determined by the repo's state and the query
+    etag = f"{repo_etag(revision)}-{entries_cursor(after) if after else ''}-{limit}"
+    return repo_json_response(access_key, revision, etag, render)
+
+@app.route('/api/repo/<access_key>/export')
+def api_repo_export(access_key):
+    """ API Route for downloading a repo, with the same access rules as GET /api/repo/<access_key>. The 'format' query
+    parameter picks Markdown ('md', the default), JSON Lines ('jsonl') or CSV ('csv'). The file is streamed as it's
+    written, from a server-side cursor over the repo's entries, and gzip compressed on the way if the client accepts it.
+    """
+    revision, error = api_repo_readable(access_key)
+    if error:
+        return jsonify(error=error['error']), error['code']
+
+    format = request.args.get('format', 'md')
+    if format not in exports.FORMATS:
+        return jsonify(error=f"Bad request, 'format' must be one of: {', '.join(exports.FORMATS)}"), 400
+    serialize, mimetype = exports.FORMATS[format]
+
     repo = Repo.query.get(access_key)
-    if not repo:
-        return jsonify(error="Repo not found"), 404
-    
-    if repo.is_private and 'working_repo' not in session:
-        return jsonify(error="Unauthorized"), 401
-    elif repo.is_private and session['working_repo'] != repo.access_key:
-        return jsonify(error="Unauthorized"), 403
-    elif repo.is_private and session['working_repo'] == repo.access_key:
-        return jsonify(repo.to_json())
-    else:
-        return jsonify(repo.to_json())
+    compress = 'gzip' in request.accept_encodings
+    chunks = exports.buffered(serialize(repo, Entry.stream_for_repo(access_key)))
+    # The request context (and with it the database session) stays open until the last chunk is sent
+    res = app.response_class(
+        stream_with_context(exports.encode(chunks, compress)), content_type=f"{mimetype}; charset=utf-8",
+        direct_passthrough=True
+    )
+    res.headers['Content-Disposition'] = f'attachment; filename="{access_key}.{format}"'
+    res.vary.add('Accept-Encoding')
+    if compress:
+        res.headers['Content-Encoding'] = 'gzip'
+    if revision.is_private:
+        res.cache_control.private = True
+    return res
 
 @app.route('/api/repo/<access_key>', methods=['DELETE'])
 def api_repo_delete(access_key):
     """ API Route for deleting a repo. Request must include a JSON payload with the following schema:
     {'pass_phrase' : String}
-    Which is the plain-text password associated with the repo. This route does not use the session for authentication.
+    Which is the plain-text password associated with the repo. This route does not use the session for authentication,
+    though a recent proof of the same pass phrase in the session spares checking it with bcrypt again.
     """
     repo = Repo.query.get(access_key)
     data = request.get_json()
@@ -153,14 +322,16 @@ def api_repo_delete(access_key):
     # Authorize
     if "pass_phrase" not in data:
         return jsonify(error="Field 'pass_phrase' required for DELETE operation."), 400
-    elif not Repo.authenticate(access_key, data['pass_phrase']):
+    elif not repo_authenticate(repo, data['pass_phrase']):
         return jsonify(error="Unauthorized"), 401
     
     db.session.delete(repo)
     db.session.commit()
+    invalidate_repo(access_key)
     # This route should only be front-end accessible if user is authenticated in the session, but we'll check just in case
     if 'working_repo' in session and session['working_repo'] == access_key:
         del session['working_repo']
+    session.pop('auth_proof', None)
 
     return jsonify(message=f"success. {access_key} deleted."), 200
 
@@ -214,7 +385,9 @@ def api_repo_patch(access_key):
         db.session.rollback()
         return jsonify(errors=errors), 400
     else:
+        repo.updated_at = db.func.now()
         db.session.commit()
+        invalidate_repo(access_key)
         return jsonify(message='success', repo=repo.to_json())
 
 @app.route('/api/repo/<access_key>/entries', methods=['POST'])
@@ -223,10 +396,13 @@ def api_repo_new_entries(access_key):
     { 'new' : [ {entry_data}, {entry_data}, ...] }
     entry_data schema matches Entry JSON schema, with title and type required, id is generated by database:
     {
-        'title' : String, required
+        'title' : String, required unless a url is given
         'type' : string, required (must match enum of database entry type, i.e. 'link', 'divider', 'text_box')
         optional_field :  value (e.g. 'description' : 'lorem ipsum' )
     }
+    An entry given a url but no title is titled with its url, and (if scrape jobs are enabled) has its title, description
+    and image filled in later by the background scraper.
+    Responds with the id and sequence of each created entry, in the order they were sent: { 'created' : [ {id, sequence} ] }
     """
     repo = Repo.query.get(access_key)
     if not repo:
@@ -237,27 +413,24 @@ def api_repo_new_entries(access_key):
         return jsonify(error=validate['error']), validate['code']
     
     data = request.get_json()
-    new_entries = []
     try:
-        for entry in data['new']:
-            new_entries.append(
-                Entry(
-                    title=entry['title'], description=entry.get('description'),
-                    image=entry.get('image'), url=entry.get('url'),
-                    type=entry['type'], rating=entry.get('rating'),
-                    sequence=entry.get('sequence'), repo_access_key=access_key
-                )
-            )
+        new_entries = api_new_entry_rows(data['new'])
     except KeyError as err:
         return jsonify(error=f"Missing field: {err.args[0]}"), 400
-    
-    db.session.add_all(new_entries)
+
     try:
+        api_queue_entry_scrapes(new_entries)
+        created = Entry.bulk_insert(access_key, new_entries)
+        version = Repo.bump_version(access_key)
         db.session.commit()
-        return jsonify(msg=f"Success. Created {len(new_entries)} on {access_key}"), 201
-    except DataError:
+        invalidate_repo(access_key)
+    except (DataError, IntegrityError):
         db.session.rollback()
         return jsonify(error="Bad request, check field types and values"), 400
+    return jsonify(
+        msg=f"Success. Created {len(created)} on {access_key}", version=version,
+        created=[{'id' : id, 'sequence' : sequence} for id, sequence in created]
+    ), 201
 
 
 @app.route('/api/repo/<access_key>/entries', methods=['PATCH'])
@@ -280,26 +453,25 @@ def api_entries_patch(access_key):
     
     data = request.get_json()
     try:
-        for entry in data['change']:
-            db_entry = Entry.query.get(entry['id'])
-            if not db_entry:
-                return jsonify(error=f"Entry id:{entry['id']} is invalid."), 400
-            if db_entry.repo_access_key != access_key:
-                return jsonify(error=f"Entry with id:{entry['id']} does not belong to repo {access_key}"), 403
-            db_entry.title = entry.get('title', db_entry.title)
-            db_entry.description = entry.get('description', db_entry.description)
-            db_entry.image = entry.get('image', db_entry.image)
-            db_entry.url = entry.get('url', db_entry.url)
-            db_entry.type = entry.get('type', db_entry.type)
-            db_entry.rating = entry.get('rating', db_entry.rating)
-            db_entry.sequence = entry.get('sequence', db_entry.sequence)
+        changes = data['change']
+        ids = [entry['id'] for entry in changes]
     except KeyError as err:
         return jsonify(error=f"Missing field: {err.args[0]}"), 400
-    
+
     try:
+        # Every targeted entry is loaded, checked and then updated in bulk, rather than one query per entry
+        rows = Entry.editable_rows(access_key, ids)
+        error = api_entries_ownership(access_key, ids, rows)
+        if error:
+            db.session.rollback()
+            return jsonify(error=error['error']), error['code']
+
+        Entry.bulk_update(rows, changes)
+        version = Repo.bump_version(access_key)
         db.session.commit()
-        return jsonify(msg=f"Success. Updated {len(data['change'])} on {access_key}")
-    except DataError as err:
+        invalidate_repo(access_key)
+        return jsonify(msg=f"Success. Updated {len(changes)} on {access_key}", version=version)
+    except (DataError, IntegrityError):
         db.session.rollback()
         return jsonify(error="Bad request, check field types and values"), 400
 
@@ -318,24 +490,282 @@ def api_entries_deletion(access_key):
     
     data = request.get_json()
     try:
-        for id in data['delete']:
-            entry = Entry.query.get(id)
-            if not entry:
-                return jsonify(error=f"Entry id:{id} is invalid."), 400
-            if entry.repo_access_key != access_key:
-                return jsonify(error=f"Entry with id:{id} does not belong to repo {access_key}"), 403
-            
-            db.session.delete(entry)
+        ids = data['delete']
     except KeyError as err:
         return jsonify(error=f"Missing field: {err.args[0]}"), 400
-    
+    if not isinstance(ids, list):
+        return jsonify(error="Bad request, field 'delete' must be a list"), 400
+
+    try:
+        # One DELETE ... RETURNING id; anything it didn't return was either missing or another repo's
+        deleted = Entry.bulk_delete(access_key, ids)
+    except DataError:
+        db.session.rollback()
+        return jsonify(error="Bad request, entry ids must be integers"), 400
+
+    error = api_entries_ownership(access_key, ids, deleted)
+    if error:
+        db.session.rollback()
+        return jsonify(error=error['error']), error['code']
+
+    version = Repo.bump_version(access_key)
     db.session.commit()
-    return jsonify(msg=f"Success. Deleted {len(data['delete'])} on {access_key}")
+    invalidate_repo(access_key)
+    return jsonify(msg=f"Success. Deleted {len(data['delete'])} on {access_key}", version=version)
+
+@app.route('/api/repo/<access_key>/sync', methods=['POST'])
+def api_repo_sync(access_key):
+    """ API Route for applying a repo's pending entry edits in one transaction, requires auth. Incoming JSON Schema:
+    {
+        'version' : Integer, required (the repo version the edits were made against)
+        'new' : [ {entry_data}, ...], optional, as for POST /api/repo/<access_key>/entries
+        'change' : [ {entry_data}, ...], optional, as for PATCH /api/repo/<access_key>/entries
+        'delete' : [entry_id, ...], optional, as for DELETE /api/repo/<access_key>/entries
+    }
+    Deletions are applied first, then changes, then new entries. If the repo has been edited since 'version', nothing is
+    applied and the response is a 409 carrying the current version. Otherwise all edits are applied or none are, and the
+    response carries the repo's new version along with the id and sequence of each created entry:
+    { 'version' : Integer, 'created' : [ {id, sequence} ] }
+    """
+    repo = Repo.query.get(access_key)
+    if not repo:
+        return jsonify(error="Repo not found"), 404
 
+    validate = api_auth_validate(request, access_key)
+    if not validate == True:
+        return jsonify(error=validate['error']), validate['code']
 
-def api_auth_validate(request, access_key):
-    """ Helper function to make sure that a restricted incoming API request includes a json payload and is authorized. """
-    if not request.is_json:
+    data = request.get_json()
+    try:
+        expected = data['version']
+        to_delete = data.get('delete', [])
+        changes = data.get('change', [])
+        ids = [entry['id'] for entry in changes]
+        new_entries = api_new_entry_rows(data.get('new', []))
+    except KeyError as err:
+        return jsonify(error=f"Missing field: {err.args[0]}"), 400
+    except (TypeError, AttributeError):
+        return jsonify(error="Bad request, check field types and values"), 400
+    if not isinstance(expected, int) or isinstance(expected, bool) or not isinstance(to_delete, list):
+        return jsonify(error="Bad request, check field types and values"), 400
+
+    # Conditionally bumping the version first both rejects stale edits and holds the repo's row lock, so concurrent
+    # syncs of one repo apply one after the other
+    version = Repo.bump_version(access_key, expected=expected)
+    if version is None:
+        db.session.rollback()
+        return jsonify(error="Repo has been changed since this version, reload it", version=repo.version), 409
+
+    try:
+        if to_delete:
+            deleted = Entry.bulk_delete(access_key, to_delete)
+            error = api_entries_ownership(access_key, to_delete, deleted)
+            if error:
+                db.session.rollback()
+                return jsonify(error=error['error']), error['code']
+        if changes:
+            rows = Entry.editable_rows(access_key, ids)
+            error = api_entries_ownership(access_key, ids, rows)
+            if error:
+                db.session.rollback()
+                return jsonify(error=error['error']), error['code']
+            Entry.bulk_update(rows, changes)
+
+        api_queue_entry_scrapes(new_entries)
+        created = Entry.bulk_insert(access_key, new_entries)
+        db.session.commit()
+        invalidate_repo(access_key)
+    except (DataError, IntegrityError):
+        db.session.rollback()
+        return jsonify(error="Bad request, check field types and values"), 400
+
+    return jsonify(
+        msg=f"Success. Synced {access_key} to version {version}", version=version,
+        created=[{'id' : id, 'sequence' : sequence} for id, sequence in created]
+    )
+
+@app.route('/api/repo/<access_key>/import', methods=['POST'])
+def api_repo_import(access_key):
+    """ API Route for appending the entries of an uploaded file to a repo, requires auth. Takes a multipart form with:
+    'file' : the upload, a Markdown link list (as written by the Markdown export) or a browser's Netscape bookmarks HTML
+    'format' : optional, 'md' or 'html', guessed from the file name if not given
+    'enrich' : optional, '1' to fill in the missing titles, descriptions and images of links from their pages
+    The file is parsed as it is read, and its entries inserted IMPORT_BATCH_SIZE at a time, all in one transaction.
+    Enrichment is left to the background scraper when scrape jobs are enabled, otherwise it happens batch by batch
+    before inserting, until IMPORT_ENRICH_DEADLINE seconds into the request. Responds like POST /api/repo/<access_key>/entries: { 'version', 'created' : [ {id, sequence} ] }
+    """
+    repo = Repo.query.get(access_key)
+    if not repo:
+        return jsonify(error="Repo not found"), 404
+
+    validate = api_auth_validate(request, access_key, json=False)
+    if not validate == True:
+        return jsonify(error=validate['error']), validate['code']
+
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify(error="Missing field: file"), 400
+    format = request.form.get('format') or imports.guess_format(upload.filename)
+    if format not in imports.PARSERS:
+        return jsonify(error=f"Bad request, format must be one of {', '.join(imports.PARSERS)}"), 400
+    enrich = request.form.get('enrich') == '1'
+    enrich_deadline = time.monotonic() + app.config['IMPORT_ENRICH_DEADLINE']
+
+    sequence = Entry.next_sequence(access_key)
+    created = []
+    try:
+        entries = imports.PARSERS[format](imports.read_text(upload.stream))
+        for batch in imports.batches(entries, app.config['IMPORT_BATCH_SIZE']):
+            if len(created) + len(batch) > app.config['IMPORT_MAX_ENTRIES']:
+                db.session.rollback()
+                return jsonify(error=f"Bad request, at most {app.config['IMPORT_MAX_ENTRIES']} entries per import"), 400
+
+            rows = api_new_entry_rows(batch)
+            for row in rows:
+                row['sequence'] = sequence
+                sequence += 1
+            if enrich:
+                imports.mark_for_enrichment(rows)
+                if not app.config['SCRAPE_JOBS']:
+                    imports.enrich(rows, enrich_deadline)
+            api_queue_entry_scrapes(rows)
+            created.extend(Entry.bulk_insert(access_key, rows))
+
+        version = Repo.bump_version(access_key)
+        db.session.commit()
+        invalidate_repo(access_key)
+    except (DataError, IntegrityError):
+        db.session.rollback()
+        return jsonify(error="Bad request, check field types and values"), 400
+
+    return jsonify(
+        msg=f"Success. Imported {len(created)} on {access_key}", version=version,
+        created=[{'id' : id, 'sequence' : sequence} for id, sequence in created]
+    ), 201
+
+
+def repo_authenticate(repo, pass_phrase):
+    """ Helper function checking a repo's pass phrase. A fresh proof in the session of the same pass phrase having been
+    checked (see hashing.make_proof) is accepted without running bcrypt again; otherwise the check is Repo.authenticate,
+    and success leaves a new proof in the session. """
+    secret = app.config['SECRET_KEY']
+    if hashing.check_proof(session.get('auth_proof'), secret, repo.access_key, repo.pass_phrase, pass_phrase):
+        return True
+    if not Repo.authenticate(repo.access_key, pass_phrase):
+        return False
+    # repo is the session's instance, so carries any rehashed pass phrase
+    session['auth_proof'] = hashing.make_proof(secret, repo.access_key, repo.pass_phrase, pass_phrase)
+    return True
+
+def repo_etag(revision):
+    """ Helper function building a repo's strong ETag from its Repo.revision row. Everything in the repo's JSON either
+    moves updated_at when it changes or is part of the tag itself. """
+    return f"{revision.version}-{revision.updated_at.timestamp():.6f}-{revision.last_visited.isoformat()}"
+
+def api_repo_readable(access_key):
+    """ Helper function for read routes, loading a repo's Repo.revision row and checking the client may see the repo.
+    Returns (revision, None), or (None, {'error', 'code'}) if the repo is missing or private to another client. """
+    revision = Repo.revision(access_key)
+    if not revision:
+        return None, {'error' : 'Repo not found', 'code' : 404}
+    if revision.is_private and 'working_repo' not in session:
+        return None, {'error' : 'Unauthorized', 'code' : 401}
+    elif revision.is_private and session['working_repo'] != access_key:
+        return None, {'error' : 'Unauthorized', 'code' : 403}
+    return revision, None
+
+def repo_json_response(access_key, revision, etag, render, cache_kind=None):
+    """ Helper function building the conditional response to a read of a repo: an empty 304 if the request's If-None-Match
+    holds etag, otherwise the JSON returned by render(), taken from the response cache (under cache_kind) if the repo
+    is public. """
+    # Should the repo change in between, the ETag is older than the JSON, costing the client one extra refetch
+    if request.if_none_match.contains(etag):
+        res = app.response_class(status=304)
+    elif cache_kind and not revision.is_private:
+        payload, hit = cached_repo_payload(cache_kind, access_key, etag, render)
+        res = app.response_class(payload, mimetype='application/json')
+        res.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+    else:
+        res = app.response_class(render(), mimetype='application/json')
+
+    res.set_etag(etag)
+    res.last_modified = revision.updated_at
+    # Clients may keep the JSON, but must revalidate it on every use
+    res.cache_control.no_cache = True
+    if revision.is_private:
+        res.cache_control.private = True
+    return res
+
+def entries_cursor(entry):
+    """ Helper function encoding the position of an entry ({'sequence', 'id'} or a (sequence, id) tuple) as a cursor for
+    the 'after' parameter of GET /api/repo/<access_key>/entries. """
+    sequence, id = (entry['sequence'], entry['id']) if isinstance(entry, dict) else entry
+    return f"{'' if sequence is None else sequence}:{id}"
+
+def parse_entries_cursor(cursor):
+    """ Helper function decoding an entries_cursor back into a (sequence, id) tuple. Raises ValueError if malformed. """
+    sequence, _, id = cursor.partition(':')
+    return (int(sequence) if sequence else None, int(id))
+
+def cached_repo_payload(kind, access_key, etag, render):
+    """ Helper function returning a public repo's rendered 'json', 'summary' or 'html' from response_cache, calling
+    render() and caching the result on a miss. A cached payload is only used while its ETag still matches the repo's,
+    so a change this process never heard of (e.g. the scrape worker's) isn't served stale. Returns (payload, hit). """
+    key = f"{kind}:{access_key}"
+    cached = response_cache.get(key)
+    if cached is not None and cached[0] == etag:
+        return cached[1], True
+
+    payload = render()
+    response_cache.set(key, [etag, payload], app.config['RESPONSE_CACHE_TTL'])
+    return payload, False
+
+def invalidate_repo(access_key):
+    """ Helper function dropping a repo's cached responses, called by every route that changes the repo. """
+    for kind in ('json', 'summary', 'html'):
+        response_cache.delete(f"{kind}:{access_key}")
+
+def api_new_entry_rows(entries):
+    """ Helper function converting a request's new entry_data into rows for Entry.bulk_insert. Raises KeyError for a
+    missing required field. Rows given a url but no title are titled with their url and marked for scraping. """
+    rows = []
+    for entry in entries:
+        # Entries may be created from just a URL, to be titled by the scraper
+        scrape = 'title' not in entry and isinstance(entry.get('url'), str) and bool(entry['url'])
+        row = {field : entry.get(field) for field in Entry.EDITABLE}
+        row['title'] = entry['url'] if scrape else entry['title']
+        row['type'] = entry['type']
+        row['scrape'] = scrape
+        rows.append(row)
+    return rows
+
+def api_queue_entry_scrapes(rows):
+    """ Helper function pointing the rows marked for scraping at a background scrape job of their url (when scrape jobs
+    are enabled), queueing every missing job with one statement. """
+    to_scrape = [row for row in rows if row['scrape']]
+    if not to_scrape or not app.config['SCRAPE_JOBS']:
+        return
+    urls = [job_url(row['url'], quoted=False) for row in to_scrape]
+    jobs = ScrapeJob.enqueue_many(urls)
+    for row, url in zip(to_scrape, urls):
+        row['scrape_job_id'] = jobs[url]
+
+def api_entries_ownership(access_key, ids, found):
+    """ Helper function to check set-wise that each of a request's entry ids was found on the repo. Returns None if so,
+    otherwise the error for the first id that wasn't: 403 if it belongs to another repo, 400 if it doesn't exist. """
+    missing = [id for id in ids if id not in found]
+    if not missing:
+        return None
+
+    id = missing[0]
+    if id in Entry.owners(missing):
+        return {'error' : f"Entry with id:{id} does not belong to repo {access_key}", 'code' : 403}
+    return {'error' : f"Entry id:{id} is invalid.", 'code' : 400}
+
+def api_auth_validate(request, access_key, json=True):
+    """ Helper function to make sure that a restricted incoming API request includes a json payload (unless json is
+    False) and is authorized. """
+    if json and not request.is_json:
         return {'error' : 'Bad request, payload must be JSON', 'code' : 400}
     if not 'working_repo' in session:
         return {'error' : 'Operation requires authentication', 'code': 401}
@@ -343,3 +773,86 @@ def api_auth_validate(request, access_key):
         return {'error' : 'Not authorized for this operation', 'code' : 403}
     
     return True
+
+
+### Metrics ###
+
+@app.route('/metrics')
+def metrics_view():
+    """ Prometheus scrape target: request latency, DB and scrape timings and cache stats, summed over every worker
+    process (see metrics.py). """
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return jsonify(error="Unauthorized"), 401
+    body, content_type = metrics.exposition()
+    return app.response_class(body, content_type=content_type)
+
+
+### CLI ###
+
+@app.cli.command('cull-repos')
+@click.option('--days', default=180, show_default=True, help='Delete repos not visited for this many days.')
+@click.option('--batch-size', default=200, show_default=True, help='Repos deleted per transaction.')
+@click.option('--sleep', default=0.5, show_default=True, help='Seconds to pause between batches.')
+@click.option('--lock-timeout', default=2000, show_default=True, help='Milliseconds a batch may wait on a lock before retrying.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be deleted.')
+def cull_repos(days, batch_size, sleep, lock_timeout, dry_run):
+    """ Deletes repos (and their entries) that haven't been visited in DAYS days. Each batch is its own short transaction
+    that gives up quickly on locks held by live traffic, so it can run against a live database. """
+    cutoff = date.today() - timedelta(days=days)
+    idle = Repo.idle(cutoff)
+    total = idle.count()
+    if dry_run:
+        entries = Entry.query.filter(Entry.repo_access_key.in_(idle.with_entities(Repo.access_key))).count()
+        click.echo(f"Would delete {total} repos with {entries} entries, last visited before {cutoff}.")
+        return
+
+    deleted = 0
+    failures = 0
+    while True:
+        try:
+            db.session.execute(db.text("SELECT set_config('lock_timeout', :timeout, true)"), {'timeout' : f"{lock_timeout}ms"})
+            culled = Repo.cull(cutoff, batch_size)
+            db.session.commit()
+        except OperationalError:
+            db.session.rollback()
+            failures += 1
+            if failures == 3:
+                raise click.ClickException(f"Stopped after three lock timeouts in a row, {deleted} repos were deleted.")
+            click.echo('Batch timed out waiting on a lock, retrying.')
+            time.sleep(sleep)
+            continue
+
+        failures = 0
+        deleted += len(culled)
+        click.echo(f"Deleted {deleted}/{total} repos.")
+        # A short batch means nothing idle is left, apart from repos that were locked (left for the next run)
+        if len(culled) < batch_size:
+            break
+        time.sleep(sleep)
+
+    click.echo(f"Done. Deleted {deleted} repos last visited before {cutoff}.")
+
+def purge_batches(purge, batch_size, sleep):
+    """ Calls purge(batch_size) in its own transaction until it deletes fewer rows than that, sleep seconds apart.
+    Returns the total deleted. """
+    deleted = 0
+    while True:
+        purged = purge(batch_size)
+        db.session.commit()
+        deleted += purged
+        if purged < batch_size:
+            return deleted
+        time.sleep(sleep)
+
+@app.cli.command('purge-scrapes')
+@click.option('--job-days', default=1, show_default=True, help='Keep finished scrape jobs updated within this many days.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows deleted per transaction.')
+@click.option('--sleep', default=0.1, show_default=True, help='Seconds to pause between batches.')
+def purge_scrapes(job_days, batch_size, sleep):
+    """ Deletes expired rows of the shared scrape cache, and scrape jobs that finished more than job_days ago, neither
+    of which is read again but would otherwise stay forever. """
+    cached = purge_batches(ScrapeCache.purge, batch_size, sleep)
+    cutoff = datetime.utcnow() - timedelta(days=job_days)
+    jobs = purge_batches(lambda limit: ScrapeJob.purge(cutoff, limit), batch_size, sleep)
+    click.echo(f"Deleted {cached} expired scrape cache entries and {jobs} finished scrape jobs.")
@@ -0,0 +1,127 @@
+""" Micro-benchmarks for hot paths that don't need a running server. Run from the project root, e.g.:
+    python benchmarks.py parse [path/to/saved/pages]
+    python benchmarks.py keygen [number of keys]
+"""
+import os
+import sys
+import timeit
+from random import random, choice, seed
+from datetime import datetime
+from scrape import parse_HTML
+from utils import generate_access_key, ACCESS_KEY_LENGTH, ACCESS_KEY_ALPHABET
+
+def legacy_parse_HTML(content):
+    """ The original partition-loop OpenGraph parser, kept as a baseline for bench_parse. """
+    tags = {}
+    remain = content
+    while (remain):
+        after = remain.partition('property="og:')[2]
+        y1 = after.find('/>')
+        y2 = after.find('>')
+
+        if y1 == -1:
+            y = y2
+        elif y2 == -1:
+            y = y1
+        elif y1 < y2:
+            y = y1
+        else:
+            y = y2
+
+        meat = after[:y]
+        key = meat.partition('"')[0]
+        value = meat.partition('content="')[2]
+        value = value.strip('" ')
+        if key and value:
+            tags[key] = value
+        remain = after
+
+    if 'title' not in tags:
+        tags['title'] = content.partition('<title>')[2].partition('</title>')[0]
+    if 'description' not in tags:
+        desc = content.partition('<meta name="description" content="')[2]
+        y1 = desc.find('/>')
+        y2 = desc.find('>')
+        if y1 == -1:
+            y = y2
+        elif y2 == -1:
+            y = y1
+        elif y1 < y2:
+            y = y1
+        else:
+            y = y2
+
+        tags['description'] = desc[:y].strip(' "')
+    return tags
+
+def synthetic_corpus():
+    """ Stand-in for saved pages: heads of increasing size, padded with the scripts and link tags real sites carry. """
+    pages = {}
+    for size in (10, 100, 1000):
+        head = ['<head><meta charset="utf-8"><title>Synthetic page</title>']
+        head.append('<meta name="description" content="A page for benchmarking.">')
+        for i in range(size):
+            head.append(f'<meta property="og:tag{i}" content="value {i}">')
+            head.append(f'<link rel="preload" href="/static/{i}.js"><script>var x{i} = "{i}";</script>')
+        head.append('<meta property="og:title" content="Synthetic" /><meta property="og:image" content="/i.png"></head>')
+        body = '<body>' + ('<p>Lorem ipsum dolor sit amet.</p>' * size * 10) + '</body>'
+        pages[f'synthetic-{size}'] = '<html>' + ''.join(head) + body + '</html>'
+    return pages
+
+def load_corpus(directory):
+    pages = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(('.html', '.htm')):
+            with open(os.path.join(directory, name), encoding='utf-8', errors='replace') as f:
+                pages[name] = f.read()
+    return pages
+
+def bench_parse(directory=None, number=20):
+    """ Times parse_HTML against the legacy parser on each page of a corpus of saved HTML pages (or a synthetic one). """
+    pages = load_corpus(directory) if directory else synthetic_corpus()
+    print(f"{'page':<32}{'bytes':>10}{'legacy ms':>12}{'parser ms':>12}{'speedup':>10}")
+    for name, page in pages.items():
+        legacy = timeit.timeit(lambda: legacy_parse_HTML(page), number=number) / number * 1000
+        current = timeit.timeit(lambda: parse_HTML(page), number=number) / number * 1000
+        print(f"{name[:31]:<32}{len(page):>10}{legacy:>12.3f}{current:>12.3f}{legacy / current:>9.1f}x")
+
+def legacy_generate_access_key():
+    """ The original access key generator, reseeding the random module from the clock on every call, kept as a baseline
+    for bench_keygen. """
+    chars = "abcdefghijklmnopqrstuwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&**()_+-=[];:'<>,.?"
+    seed_str = str(datetime.now())
+    for x in str(random()):
+        seed_str = seed_str + x + choice(chars)
+    seed(seed_str)
+    key = ""
+    alphabet = "abcdefghijklmnopqrstuwxyz1234567890"
+    for i in range(0, 10):
+        key = key + (choice(alphabet) if random() > 0.5 else choice(alphabet).upper())
+    return key
+
+def bench_keygen(passes=200000):
+    """ Times each access key generator over a number of keys, counting the duplicates it produced against the number a
+    uniformly random key of its length and alphabet would be expected to (the birthday bound, n^2 / 2N). """
+    passes = int(passes)
+    space = len(set(ACCESS_KEY_ALPHABET)) ** ACCESS_KEY_LENGTH
+    print(f"{'generator':<12}{'keys/s':>12}{'duplicates':>12}{'expected':>12}")
+    for name, generate in (('legacy', legacy_generate_access_key), ('secrets', generate_access_key)):
+        seen = set()
+        duplicates = 0
+        start = timeit.default_timer()
+        for _ in range(passes):
+            key = generate()
+            if key in seen:
+                duplicates += 1
+            seen.add(key)
+        elapsed = timeit.default_timer() - start
+        # The legacy alphabet is 35 characters (no 'v'), each letter in either case
+        expected = passes ** 2 / (2 * (space if name == 'secrets' else 60 ** 10))
+        print(f"{name:<12}{passes / elapsed:>12.0f}{duplicates:>12}{expected:>12.2g}")
+
+if __name__ == '__main__':
+    benches = {'parse' : bench_parse, 'keygen' : bench_keygen}
+    if len(sys.argv) < 2 or sys.argv[1] not in benches:
+        print(f"Usage: python benchmarks.py [{'|'.join(benches)}] [args...]")
+        sys.exit(1)
+    benches[sys.argv[1]](*sys.argv[2:])
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """ Thread-safe, size-bounded, in-process cache with least-recently-used eviction and optional per-entry TTLs.
+    A lookup of a missing or expired key returns None, so None itself can't be cached. """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None, expires_at=None):
+        """ Stores value under key. Expiry is given either relative (ttl, in seconds) or absolute (expires_at, epoch seconds). """
+        if ttl is not None:
+            expires_at = time.time() + ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {
+            "size" : len(self._data),
+            "max_size" : self.max_size,
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "evictions" : self.evictions,
+            "hit_ratio" : self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+        }
+
+
+class TieredCache:
+    """ An LRUCache in front of an optional shared store, so entries can be reused across processes and restarts.
+    The store is any object providing:
+        fetch(key) -> (value, expires_at) or None
+        save(key, value, expires_at)
+        discard(key)
+    where expires_at is in epoch seconds. Values must be JSON-serializable if the store persists them. """
+
+    def __init__(self, max_size=1024, store=None):
+        self.local = LRUCache(max_size)
+        self.store = store
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None or self.store is None:
+            return value
+
+        found = self.store.fetch(key)
+        if found is None:
+            self.shared_misses += 1
+            return None
+
+        value, expires_at = found
+        self.shared_hits += 1
+        # Promote into the local tier with the store's remaining lifetime
+        self.local.set(key, value, expires_at=expires_at)
+        return value
+
+    def set(self, key, value, ttl):
+        expires_at = time.time() + ttl
+        self.local.set(key, value, expires_at=expires_at)
+        if self.store is not None:
+            self.store.save(key, value, expires_at)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.store is not None:
+            self.store.discard(key)
+
+    def stats(self):
+        stats = self.local.stats()
+        stats['shared_hits'] = self.shared_hits
+        stats['shared_misses'] = self.shared_misses
+        return stats
+
+
+class DiskStore:
+    """ A TieredCache store keeping each entry as a JSON file in a local directory, so that every process on the machine
+    (e.g. each gunicorn worker) shares it. Files are replaced atomically, and expired ones are removed when next read. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def fetch(self, key):
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                value, expires_at = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if expires_at <= time.time():
+            self.discard(key)
+            return None
+        return value, expires_at
+
+    def save(self, key, value, expires_at):
+        # Written to a temporary file first, so readers never see a partial entry
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([value, expires_at], f)
+            os.replace(temp, self._path(key))
+        except OSError:
+            self._unlink(temp)
+
+    def discard(self, key):
+        self._unlink(self._path(key))
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
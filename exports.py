@@ -0,0 +1,92 @@
+""" Streaming serializers for repo exports (GET /api/repo/<access_key>/export). Each format is a generator of text
+chunks, fed entries one at a time from Entry.stream_for_repo, so no export holds more than a chunk in memory. """
+import csv
+import io
+import json
+import re
+import zlib
+
+# Text is handed on once this many characters have built up, rather than one tiny chunk per entry
+CHUNK_SIZE = 16 * 1024
+CSV_FIELDS = ('id', 'type', 'title', 'description', 'url', 'image', 'rating', 'sequence')
+MD_ESCAPE_RE = re.compile(r'([\\\[\]*_`])')
+
+def buffered(chunks, size=CHUNK_SIZE):
+    """ Joins small text chunks into ones of at least size characters. """
+    buffer = []
+    length = 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield ''.join(buffer)
+
+def md_text(text):
+    """ Single-line Markdown text, with the characters that would start a link or emphasis escaped. """
+    return MD_ESCAPE_RE.sub(r'\\\1', ' '.join((text or '').split()))
+
+def md_link(title, url):
+    # Angle brackets keep spaces and parentheses in a URL from ending it early
+    target = f"<{url}>" if re.search(r'[\s()<>]', url) else url
+    return f"[{md_text(title) or md_text(url)}]({target})"
+
+def export_md(repo, entries):
+    """ Markdown: the repo's title and description, then a list item per link, a heading per divider and a paragraph
+    per text box. """
+    yield f"# {md_text(repo.title) or repo.access_key}\n\n"
+    if repo.description:
+        yield f"{md_text(repo.description)}\n\n"
+
+    for entry in entries:
+        title, url, description = entry['title'], entry['url'], md_text(entry['description'])
+        if entry['type'] == 'divider':
+            yield f"\n## {md_link(title, url) if url else md_text(title)}\n\n" if title else "\n---\n\n"
+        elif entry['type'] == 'text_box':
+            lines = [f"**{md_text(title)}**" if title else '', description, f"<{url}>" if url else '']
+            yield '\n\n'.join(line for line in lines if line) + '\n\n'
+        else:
+            item = md_link(title, url) if url else md_text(title)
+            yield f"- {item} - {description}\n" if description else f"- {item}\n"
+
+def export_jsonl(repo, entries):
+    """ JSON Lines: one entry's JSON per line. """
+    for entry in entries:
+        yield json.dumps(entry) + '\n'
+
+def export_csv(repo, entries):
+    """ CSV: a header row, then one row per entry. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_FIELDS)
+    for entry in entries:
+        writer.writerow([entry[field] for field in CSV_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+# format : (serializer, mimetype)
+FORMATS = {
+    'md' : (export_md, 'text/markdown'),
+    'jsonl' : (export_jsonl, 'application/x-ndjson'),
+    'csv' : (export_csv, 'text/csv')
+}
+
+def encode(chunks, compress=False):
+    """ UTF-8 encodes text chunks, gzip compressing them on the fly if compress is set. """
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+
+    # wbits of 16 + 15 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,39 @@
+""" Gunicorn settings for the web process (`gunicorn -c gunicorn.conf.py app:app`, as in the Procfile).
+
+Requests spend most of their time waiting on I/O: outbound scrapes and Postgres. Sync workers handle one request each,
+so a few slow sites could tie up the whole site. By default each worker runs
+GUNICORN_THREADS request threads (the gthread worker); the app's shared state (caches, scrape pool, visit tracker,
+hashing pool) is thread-safe. `python loadtest.py` compares the worker classes on slow scrapes.
+"""
+import os
+import shutil
+import tempfile
+
+SUPPORTED_WORKER_CLASSES = ('gthread', 'sync')
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+if worker_class not in SUPPORTED_WORKER_CLASSES:
+    raise RuntimeError(f"GUNICORN_WORKER_CLASS must be one of {', '.join(SUPPORTED_WORKER_CLASSES)}, not {worker_class!r}")
+
+# Heroku sets WEB_CONCURRENCY from the dyno's memory
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# Request threads per gthread worker. Keep within the database pool's size plus overflow, or threads queue for connections
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if worker_class == 'gthread' else 1
+# Seconds a worker may go silent before being restarted. Scrape batches have a 20s deadline, so leave headroom
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# Every worker imports the app itself: the scrape pool, visit tracker and hashing pool start threads and processes,
+# which don't survive a fork from a preloaded master
+preload_app = False
+
+# Workers write their metrics here for /metrics to sum (see metrics.py). Set before any worker imports prometheus_client
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), f'linkbin-metrics-{os.getpid()}'))
+
+def on_starting(server):
+    # Values left by a previous run would otherwise be summed in
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
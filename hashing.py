@@ -0,0 +1,83 @@
+""" Pass phrase hashing. bcrypt is deliberately slow (each check costs ~2^BCRYPT_LOG_ROUNDS rounds of CPU), so hashes are
+computed in a small pool of worker processes: a burst of login attempts then queues for BCRYPT_PROCESSES cores instead
+of tying up every request thread, and the web process stays responsive. Once a pass phrase has been checked, a cheap
+HMAC proof of it can be kept in the session so later confirmations skip bcrypt entirely. """
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import bcrypt
+
+# Cost factor of new hashes. Existing hashes with another cost are rehashed on their next successful check
+LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+# Worker processes per web process for hashing, 0 to hash in the calling thread
+PROCESSES = int(os.environ.get('BCRYPT_PROCESSES', 2))
+# Seconds a proof of a checked pass phrase is accepted for
+PROOF_TTL = int(os.environ.get('AUTH_PROOF_TTL', 300))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def _hash(pass_phrase, log_rounds):
+    return bcrypt.hashpw(pass_phrase.encode('utf-8'), bcrypt.gensalt(log_rounds)).decode('utf-8')
+
+def _check(pass_phrase, hashed):
+    try:
+        return bcrypt.checkpw(pass_phrase.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash at all
+        return False
+
+def _run(fn, *args):
+    """ Runs fn in the hashing pool, started on first use (and again in forked web workers, which can't share it). """
+    global _pool, _pool_pid
+    if PROCESSES <= 0:
+        return fn(*args)
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Spawned rather than forked, so the workers don't inherit the web process' threads and connections
+            _pool = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        pool = _pool
+    return pool.submit(fn, *args).result()
+
+def hash_password(pass_phrase):
+    """ A salted bcrypt hash of pass_phrase, at the configured cost. """
+    return _run(_hash, pass_phrase, LOG_ROUNDS)
+
+def check_password(pass_phrase, hashed):
+    """ Checks pass_phrase against a bcrypt hash. Returns (matches, needs_rehash), where needs_rehash says the hash was
+    made with a cost other than the configured one and should be replaced while the pass phrase is at hand. """
+    if not _run(_check, pass_phrase, hashed):
+        return False, False
+    return True, hash_rounds(hashed) != LOG_ROUNDS
+
+def hash_rounds(hashed):
+    """ The cost factor of a bcrypt hash ($2b$<rounds>$<salt and hash>). """
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+def _proof_mac(secret, access_key, hashed, pass_phrase):
+    # Keyed by the stored hash too, so changing the pass phrase invalidates outstanding proofs
+    message = '\0'.join((access_key, hashed, pass_phrase)).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+def make_proof(secret, access_key, hashed, pass_phrase):
+    """ A proof, to keep in the (signed) session, that pass_phrase was just checked against a repo's hash. It holds an
+    HMAC of the pass phrase under the app's secret, never the pass phrase itself. """
+    return {'key' : access_key, 'mac' : _proof_mac(secret, access_key, hashed, pass_phrase), 'at' : int(time.time())}
+
+def check_proof(proof, secret, access_key, hashed, pass_phrase):
+    """ Whether a proof from make_proof, less than PROOF_TTL seconds old, shows pass_phrase is the repo's pass phrase.
+    A single HMAC, so microseconds instead of bcrypt's hundreds of milliseconds. """
+    if not isinstance(proof, dict) or proof.get('key') != access_key:
+        return False
+    if not isinstance(proof.get('at'), int) or time.time() - proof['at'] > PROOF_TTL:
+        return False
+    return hmac.compare_digest(str(proof.get('mac')), _proof_mac(secret, access_key, hashed, pass_phrase))
@@ -0,0 +1,227 @@
+""" Streaming parsers for repo imports (POST /api/repo/<access_key>/import). Each parser turns an uploaded file, read a
+chunk or line at a time, into a generator of new entry_data dicts, so no import holds the whole file in memory. """
+import codecs
+import re
+import time
+from html.parser import HTMLParser
+from scrape import get_tags_batch
+
+# Bytes read from the upload at a time
+CHUNK_SIZE = 64 * 1024
+
+MD_LINK_RE = re.compile(r'\[((?:\\.|[^\\\]])*)\]\(\s*(?:<([^>]*)>|([^\s)]+))(?:\s+"[^"]*")?\s*\)')
+MD_HEADING_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*#*$')
+MD_RULE_RE = re.compile(r'^([-*_])(\s*\1){2,}$')
+MD_BOLD_RE = re.compile(r'^\*\*(.+)\*\*$')
+MD_ITEM_RE = re.compile(r'^(?:[-*+]|\d+[.)])\s+')
+MD_UNESCAPE_RE = re.compile(r'\\(.)')
+BARE_URL_RE = re.compile(r'^<?(https?://[^\s>]+)>?$')
+
+def read_text(stream, chunk_size=CHUNK_SIZE):
+    """ Generates text chunks from a binary upload stream, decoded as UTF-8 (replacing anything undecodable), with any
+    style of line ending turned into '\\n'. Only the stream's read() is used: Werkzeug spools uploads to a
+    SpooledTemporaryFile, which can't be wrapped in a TextIOWrapper before Python 3.11. """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    carry = ''
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        text = carry + decoder.decode(chunk)
+        # A trailing carriage return may be the first half of a CRLF split between reads
+        carry = '\r' if text.endswith('\r') else ''
+        text = text[:len(text) - len(carry)]
+        if text:
+            yield text.replace('\r\n', '\n').replace('\r', '\n')
+    text = carry + decoder.decode(b'', final=True)
+    if text:
+        yield text.replace('\r\n', '\n').replace('\r', '\n')
+
+def lines(chunks):
+    """ Generates the lines of text arriving in chunks, without their line endings. """
+    partial = ''
+    for chunk in chunks:
+        split = (partial + chunk).split('\n')
+        partial = split.pop()
+        yield from split
+    if partial:
+        yield partial
+
+def md_unescape(text):
+    return MD_UNESCAPE_RE.sub(r'\1', text).strip()
+
+def parse_markdown(chunks):
+    """ Markdown link lists, like those written by the Markdown export: each [title](url), or bare URL on a line or list
+    item of its own, becomes a link, with the text after it on a list item as its description. Headings below the first
+    level and horizontal rules become dividers, a **bold** line starts a text box and other text becomes a text box's
+    description. """
+    text_box = None
+    # Text straight after the top level heading is the (exported) repo's own description
+    repo_description = False
+    for line in lines(chunks):
+        line = line.strip()
+        heading = MD_HEADING_RE.match(line)
+        links = list(MD_LINK_RE.finditer(line))
+        bare = BARE_URL_RE.match(MD_ITEM_RE.sub('', line, count=1))
+        bold = MD_BOLD_RE.match(line)
+        rule = MD_RULE_RE.match(line)
+        plain = line and not (heading or links or bare or bold or rule or MD_ITEM_RE.match(line))
+
+        # The export writes a text box's url as <url> after its text
+        if text_box and bare and line.startswith('<') and 'url' not in text_box:
+            text_box['url'] = bare.group(1)
+            yield text_box
+            text_box = None
+            continue
+        # Anything but more plain text ends a text box
+        if text_box and line and not plain:
+            yield text_box
+            text_box = None
+
+        if not line:
+            continue
+        if repo_description and plain:
+            continue
+        repo_description = False
+
+        if heading:
+            # The top level heading is the (exported) repo's own title
+            repo_description = len(heading.group(1)) == 1
+            if not repo_description:
+                link = MD_LINK_RE.fullmatch(heading.group(2))
+                if link:
+                    yield {'type' : 'divider', 'title' : md_unescape(link.group(1)), 'url' : link.group(2) or link.group(3)}
+                else:
+                    yield {'type' : 'divider', 'title' : md_unescape(heading.group(2))}
+        elif rule:
+            yield {'type' : 'divider', 'title' : ''}
+        elif links:
+            for link in links:
+                entry = {'type' : 'link', 'url' : link.group(2) or link.group(3)}
+                if md_unescape(link.group(1)):
+                    entry['title'] = md_unescape(link.group(1))
+                if len(links) == 1:
+                    description = line[link.end():].strip().lstrip('-:–—').strip()
+                    if description:
+                        entry['description'] = md_unescape(description)
+                yield entry
+        elif bare:
+            yield {'type' : 'link', 'url' : bare.group(1)}
+        elif bold:
+            text_box = {'type' : 'text_box', 'title' : md_unescape(bold.group(1))}
+        elif plain:
+            text_box = text_box or {'type' : 'text_box', 'title' : ''}
+            description = md_unescape(line)
+            text_box['description'] = f"{text_box['description']}\n{description}" if 'description' in text_box else description
+
+    if text_box:
+        yield text_box
+
+
+class BookmarksParser(HTMLParser):
+    """ Incremental parser of the Netscape bookmark file format browsers export: <DT><A HREF=...>title</A> links, with
+    an optional <DD> description after each, inside <DT><H3>folder</H3> sections (which become dividers). Found
+    entries collect in self.entries. """
+
+    # Browser-internal bookmarks that mean nothing outside of the browser
+    SKIPPED_SCHEMES = ('place:', 'javascript:', 'about:', 'chrome:')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.entries = []
+        self.pending = None
+        self.text = None
+        self.href = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('a', 'h3'):
+            self.close_pending()
+            self.href = dict(attrs).get('href') if tag == 'a' else None
+            self.text = []
+        elif tag == 'dd' and self.pending is not None:
+            self.text = []
+        elif tag in ('dt', 'dl', 'h1'):
+            self.close_pending()
+
+    def handle_endtag(self, tag):
+        if tag in ('dl', 'dt'):
+            self.close_pending()
+        if self.text is None:
+            return
+        text = ' '.join(''.join(self.text).split())
+        if tag == 'a':
+            if self.href and not self.href.lower().startswith(self.SKIPPED_SCHEMES):
+                self.pending = {'type' : 'link', 'url' : self.href}
+                if text:
+                    self.pending['title'] = text
+            self.text = None
+        elif tag == 'h3':
+            self.entries.append({'type' : 'divider', 'title' : text})
+            self.text = None
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+
+    def close_pending(self):
+        """ Finishes the last link, with any <DD> description read since. """
+        if self.pending is not None:
+            description = ' '.join(''.join(self.text or []).split())
+            if description:
+                self.pending['description'] = description
+            self.entries.append(self.pending)
+        self.pending = None
+        self.text = None
+
+def parse_bookmarks(chunks):
+    """ Netscape bookmark HTML files, as exported by every major browser. """
+    parser = BookmarksParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.entries
+        parser.entries.clear()
+    parser.close()
+    parser.close_pending()
+    yield from parser.entries
+
+PARSERS = {
+    'md' : parse_markdown,
+    'html' : parse_bookmarks
+}
+
+def guess_format(filename):
+    return 'html' if (filename or '').lower().endswith(('.html', '.htm')) else 'md'
+
+def batches(entries, size):
+    """ Groups a generator's items into lists of up to size. """
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def mark_for_enrichment(rows):
+    """ Marks each link row (as made by app.api_new_entry_rows) missing a description or image for scraping, along with
+    the untitled rows already marked. """
+    for row in rows:
+        if row['type'] == 'link' and isinstance(row['url'], str) and row['url'] and not (row['description'] and row['image']):
+            row['scrape'] = True
+
+def enrich(rows, deadline):
+    """ Fills in the missing titles, descriptions and images of the rows marked for scraping from their pages' metadata,
+    fetched inside the request by get_tags_batch, with its per-host and overall concurrency limits. deadline (a
+    time.monotonic() value) is shared by all of an import's batches, so the request as a whole is bounded; rows not
+    scraped by then keep what was imported. Like the background scraper, only a title that is still the row's URL is
+    replaced. """
+    links = [row for row in rows if row['scrape']]
+    remaining = deadline - time.monotonic()
+    if not links or remaining <= 0:
+        return
+    for row, result in zip(links, get_tags_batch([row['url'] for row in links], deadline=remaining)):
+        data = result.get('data')
+        if not data:
+            continue
+        if row['title'] == row['url']:
+            row['title'] = data.get('title') or data.get('site_name') or row['title']
+        row['description'] = row['description'] or data.get('description') or None
+        row['image'] = row['image'] or data.get('image') or None
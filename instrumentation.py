@@ -0,0 +1,80 @@
+""" Per-request timing. Every statement run through SQLAlchemy is timed; inside a request, the count and total time
+build up on flask.g and are reported in the response's Server-Timing header (visible in browser dev tools), and any
+statement slower than SLOW_QUERY_MS is logged with the endpoint that ran it. Each request's latency, query count and
+DB time are also recorded in the per-endpoint histograms served at /metrics. """
+import logging
+import os
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import metrics
+
+# Statements taking longer than this many milliseconds are logged, 0 to log none
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+# Most often, in seconds, each process copies its cache stats into the metrics
+STATS_INTERVAL = 1.0
+
+logger = logging.getLogger('linkbin.db')
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    in_request = has_request_context() and 'db_queries' in g
+    if in_request:
+        g.db_queries += 1
+        g.db_time += elapsed
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning(
+            "Slow query (%.1f ms) in %s: %s", elapsed * 1000,
+            request.endpoint if in_request else 'background', ' '.join(statement.split())[:1000]
+        )
+
+@event.listens_for(Engine, 'handle_error')
+def _execute_failed(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+def db_stats():
+    """ The current request's (queries, seconds spent on them), or None outside a request. """
+    if has_request_context() and 'db_queries' in g:
+        return g.db_queries, g.db_time
+    return None
+
+def init_app(app, caches=None, visit_tracker=None, pool_stats=None):
+    """ Starts each request's counters, and reports them on its response and in the metrics. caches ({name : cache}),
+    visit_tracker and pool_stats (a function returning the outbound connection pools' stats) have their stats copied
+    into the metrics at most every STATS_INTERVAL seconds. """
+    stats_updated = [0.0]
+
+    @app.before_request
+    def start_request_timing():
+        g.db_queries = 0
+        g.db_time = 0.0
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_timing(response):
+        if 'db_queries' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_start
+        response.headers.add(
+            'Server-Timing', f'db;dur={g.db_time * 1000:.1f};desc="{g.db_queries} queries", app;dur={elapsed * 1000:.1f}'
+        )
+
+        # Requests matching no route share one label, so stray URLs can't create new series
+        endpoint = request.endpoint or 'unmatched'
+        metrics.REQUEST_LATENCY.labels(request.method, endpoint, response.status_code).observe(elapsed)
+        metrics.REQUEST_DB_QUERIES.labels(endpoint).observe(g.db_queries)
+        metrics.REQUEST_DB_TIME.labels(endpoint).observe(g.db_time)
+
+        now = time.monotonic()
+        if (caches or visit_tracker is not None or pool_stats) and now - stats_updated[0] >= STATS_INTERVAL:
+            stats_updated[0] = now
+            metrics.update_stats(caches or {}, visit_tracker, pool_stats() if pool_stats else None)
+        return response
@@ -0,0 +1,114 @@
+""" Load test of concurrent slow scrapes against gunicorn. Run from the project root, with a database migrated:
+    python loadtest.py [worker classes...] [--requests N] [--delay SECONDS]
+e.g. `python loadtest.py sync gthread`. For each worker class, starts gunicorn (with gunicorn.conf.py, 2 workers) and a
+local origin that takes --delay seconds to serve each page, then fires --requests concurrent /api/scrape requests for
+distinct (so uncached) pages and reports throughput and latency. Scrapes run inline (SCRAPE_JOBS=0), which is the
+worst case for the web process.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+PAGE = (
+    '<html><head><title>Slow page</title><meta property="og:title" content="Slow page">'
+    '<meta property="og:description" content="Served slowly."><meta property="og:image" content="/slow.png">'
+    '<meta property="og:url" content="/slow">'
+    '</head><body></body></html>'
+).encode('utf-8')
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def slow_origin(delay):
+    """ Starts a local HTTP server that waits delay seconds before serving a fully tagged page. Returns its port. """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', free_port()), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+def session_cookie():
+    """ A signed Flask session cookie authorizing scrapes, built with the app's own serializer. """
+    from app import app
+    return app.session_interface.get_signing_serializer(app).dumps({'working_repo' : 'loadtest'})
+
+def start_gunicorn(worker_class, port):
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class, WEB_CONCURRENCY='2', SCRAPE_JOBS='0')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}', 'app:app'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(f'http://127.0.0.1:{port}/api/repo/loadtest-missing', timeout=1)
+            return proc
+        except (requests.ConnectionError, requests.Timeout):
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError(f"gunicorn ({worker_class}) did not start")
+
+def run(worker_class, origin_port, cookie, number, delay):
+    port = free_port()
+    proc = start_gunicorn(worker_class, port)
+    run_id = f"{worker_class}-{time.time()}"
+
+    def scrape(i):
+        url = f'http://127.0.0.1:{origin_port}/{run_id}/{i}'
+        start = time.perf_counter()
+        res = requests.get(
+            f'http://127.0.0.1:{port}/api/scrape', params={'url' : url}, cookies={'session' : cookie}, timeout=120
+        )
+        return time.perf_counter() - start, res.status_code
+
+    try:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=number) as pool:
+            results = list(pool.map(scrape, range(number)))
+        elapsed = time.perf_counter() - start
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status != 200)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(f"{worker_class:<10}{elapsed:>10.2f}{number / elapsed:>10.1f}{statistics.median(latencies):>10.2f}{p95:>10.2f}{errors:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('worker_classes', nargs='*', default=['sync', 'gthread'])
+    parser.add_argument('--requests', type=int, default=64, help='concurrent scrape requests per worker class')
+    parser.add_argument('--delay', type=float, default=1.0, help='seconds the origin takes to serve each page')
+    args = parser.parse_args()
+
+    origin_port = slow_origin(args.delay)
+    cookie = session_cookie()
+    print(f"{args.requests} concurrent scrapes of pages served in {args.delay}s, 2 gunicorn workers")
+    print(f"{'workers':<10}{'total s':>10}{'req/s':>10}{'p50 s':>10}{'p95 s':>10}{'errors':>8}")
+    for worker_class in args.worker_classes:
+        run(worker_class, origin_port, cookie, args.requests, args.delay)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+""" Prometheus metrics, served in the text format at /metrics. Under gunicorn each worker process keeps its own values,
+so when PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it) they are written to files in that directory and
+/metrics sums every worker's, live or exited. """
+import os
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+# Seconds. Finer at the low end, where most requests should land, up to the scrape batch deadline
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+REQUEST_LATENCY = Histogram(
+    'linkbin_request_duration_seconds', 'Time to handle a request, by endpoint',
+    ['method', 'endpoint', 'status'], buckets=LATENCY_BUCKETS
+)
+REQUEST_DB_QUERIES = Histogram(
+    'linkbin_request_db_queries', 'Database statements run by a request, by endpoint', ['endpoint'], buckets=QUERY_BUCKETS
+)
+REQUEST_DB_TIME = Histogram(
+    'linkbin_request_db_seconds', 'Time a request spent on database statements, by endpoint',
+    ['endpoint'], buckets=LATENCY_BUCKETS
+)
+SCRAPE_LATENCY = Histogram(
+    'linkbin_scrape_duration_seconds', 'Time to fetch and parse a page for its metadata, by outcome',
+    ['outcome'], buckets=LATENCY_BUCKETS
+)
+OPENGRAPH_FALLBACKS = Counter(
+    'linkbin_opengraph_fallbacks_total', 'Scrapes whose tags were incomplete, so opengraph.io was also called'
+)
+
+# Point-in-time stats of each process' caches and visit tracker, refreshed after every request
+CACHE_STATS = ('size', 'hits', 'misses', 'evictions')
+CACHE_GAUGE = Gauge(
+    'linkbin_cache', 'In-process cache stats, summed over live processes', ['cache', 'stat'], multiprocess_mode='livesum'
+)
+VISIT_GAUGE = Gauge(
+    'linkbin_visit_tracker', 'Visit tracker stats, summed over live processes', ['stat'], multiprocess_mode='livesum'
+)
+# Totals over the outbound connection pools (scrape.pool_stats). Not labelled by host, as hosts come from user input
+HTTP_POOL_STATS = ('pools', 'connections', 'requests', 'free')
+HTTP_POOL_GAUGE = Gauge(
+    'linkbin_http_pool', 'Outbound HTTP connection pool stats, summed over hosts and live processes', ['stat'],
+    multiprocess_mode='livesum'
+)
+
+def update_stats(caches, visit_tracker=None, http_pools=None):
+    """ Copies the stats() of each named cache, and of the visit tracker if given, into their gauges. http_pools, if
+    given, is scrape.pool_stats()'s per-host dict, totalled into the connection pool gauge. """
+    for name, cache in caches.items():
+        stats = cache.stats()
+        for stat in CACHE_STATS:
+            CACHE_GAUGE.labels(name, stat).set(stats[stat])
+    if visit_tracker is not None:
+        for stat, value in visit_tracker.stats().items():
+            VISIT_GAUGE.labels(stat).set(value)
+    if http_pools is not None:
+        HTTP_POOL_GAUGE.labels('pools').set(len(http_pools))
+        for stat in HTTP_POOL_STATS[1:]:
+            HTTP_POOL_GAUGE.labels(stat).set(sum(pool[stat] for pool in http_pools.values()))
+
+def exposition():
+    """ The current metrics in the Prometheus text format, as (body, content type). """
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid):
+    """ Drops an exited worker's live gauges (its counters and histograms are kept). Called from gunicorn's child_exit. """
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,30 @@
+"""entry and job indexes
+
+Revision ID: 0002
+Revises: 0001a
+Create Date: 2026-10-18 06:52:14.126367
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently so a live entries table isn't locked against writes, which has to happen outside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_entries_repo_sequence', 'entries', ['repo_access_key', 'sequence', 'id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_entries_scrape_job_id', 'entries', ['scrape_job_id'], unique=False, postgresql_where=sa.text('scrape_job_id IS NOT NULL'), postgresql_concurrently=True)
+        op.create_index('ix_scrape_jobs_queue', 'scrape_jobs', ['id'], unique=False, postgresql_where=sa.text("status IN ('pending', 'running')"), postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_scrape_jobs_queue', table_name='scrape_jobs')
+    op.drop_index('ix_entries_scrape_job_id', table_name='entries')
+    op.drop_index('ix_entries_repo_sequence', table_name='entries')
@@ -0,0 +1,25 @@
+"""repo version
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 06:57:35.739252
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A constant server default lets Postgres add the column without rewriting the table
+    op.add_column('repos', sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('repos', 'version')
@@ -0,0 +1,25 @@
+"""repo updated at
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 06:59:00.631965
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # now() is evaluated once for the existing rows, so this doesn't rewrite the table either
+    op.add_column('repos', sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False))
+
+
+def downgrade():
+    op.drop_column('repos', 'updated_at')
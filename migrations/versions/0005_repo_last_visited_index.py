@@ -0,0 +1,26 @@
+"""repo last visited index
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18 07:02:29.958243
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Built concurrently so a live repos table isn't locked against writes, which has to happen outside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_repos_last_visited', 'repos', ['last_visited'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    op.drop_index('ix_repos_last_visited', table_name='repos')
@@ -1,12 +1,15 @@
 import enum
 from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
+from sqlalchemy import and_, or_, case, func, cast, values, column, any_, bindparam, select, tuple_
 from sqlalchemy.orm import backref
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from sqlalchemy.exc import SQLAlchemyError
 from utils import generate_access_key
-from datetime import datetime
+from hashing import hash_password, check_password
+from datetime import datetime, timezone, timedelta
+import os
 
 db = SQLAlchemy()
-bcrypt = Bcrypt()
 
 class EntryType(enum.Enum):
     link = 1
@@ -24,6 +27,12 @@ class EntryType(enum.Enum):
         else:
             raise TypeError
 
+class JobStatus(enum.Enum):
+    pending = 1
+    running = 2
+    done = 3
+    failed = 4
+
 class Repo(db.Model):
     __tablename__ = 'repos'
     ## Columns
@@ -33,38 +42,107 @@ class Repo(db.Model):
     description = db.Column(db.String(300))
     is_private = db.Column(db.Boolean, nullable=False, default=False)
     last_visited = db.Column(db.Date, nullable=False, default=datetime.now)
+    # Bumped by every edit of the repo's entries, so clients can tell when their copy is stale
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set by every change to the repo's JSON (entries or repo info), for HTTP caching
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    __table_args__ = (
+        # Finds the repos to cull, see Repo.cull
+        db.Index('ix_repos_last_visited', 'last_visited'),
+    )
 
     ## Relationships
-    entries = db.relationship('Entry', backref='repo', cascade='delete')
+    entries = db.relationship('Entry', backref='repo', cascade='delete', order_by='[Entry.sequence, Entry.id]')
 
     @classmethod
     def create(cls, pass_phrase, title=None, description=None, is_private=None):
-        hashed_pw = bcrypt.generate_password_hash(pass_phrase).decode('utf-8')
+        hashed_pw = hash_password(pass_phrase)
         access_key = generate_access_key()
         return cls(title=title, description=description, pass_phrase=hashed_pw, access_key=access_key, is_private=is_private)
     
+    @classmethod
+    def insert_new(cls, pass_phrase, title=None, description=None, is_private=None, attempts=5):
+        """ Hashes pass_phrase once, then inserts a repo under a fresh access key with INSERT ... ON CONFLICT DO NOTHING
+        RETURNING, drawing another key only if that one was taken. Returns a row of (access_key, pass_phrase), or None if
+        every attempt collided. Leaves committing to the caller. """
+        table = cls.__table__
+        hashed_pw = hash_password(pass_phrase)
+        for _ in range(attempts):
+            stmt = insert(table).values(
+                access_key=generate_access_key(), pass_phrase=hashed_pw, title=title, description=description,
+                is_private=bool(is_private)
+            ).on_conflict_do_nothing(index_elements=[table.c.access_key]).returning(table.c.access_key, table.c.pass_phrase)
+            created = db.session.execute(stmt).first()
+            if created:
+                return created
+        return None
+
     @classmethod
     def authenticate(cls, access_key, pass_phrase):
+        """ Checks a repo's pass phrase. A hash made at an outdated bcrypt cost is replaced on success. """
         repo = cls.query.get(access_key)
-        return repo and bcrypt.check_password_hash(repo.pass_phrase, pass_phrase)
+        if not repo:
+            return False
+        matches, needs_rehash = check_password(pass_phrase, repo.pass_phrase)
+        if needs_rehash:
+            repo.pass_phrase = hash_password(pass_phrase)
+            db.session.commit()
+        return matches
     
-    def update_last_visited(self):
-        self.last_visited = datetime.now()
-        db.session.commit()
+    @classmethod
+    def bump_version(cls, access_key, expected=None):
+        """ Increments a repo's version with a single UPDATE ... RETURNING, which also row-locks the repo until the
+        transaction ends. If expected is given, only bumps a repo still at that version. Returns the new version, or
+        None if the repo was missing or had moved past expected. """
+        table = cls.__table__
+        stmt = table.update().where(table.c.access_key == access_key)
+        if expected is not None:
+            stmt = stmt.where(table.c.version == expected)
+        stmt = stmt.values(version=table.c.version + 1, updated_at=func.now()).returning(table.c.version)
+        return db.session.execute(stmt).scalar()
 
-    def to_json(self):
-        entries = []
-        for entry in self.entries:
-            entries.append(entry.to_json())
+    @classmethod
+    def revision(cls, access_key):
+        """ Loads just the columns that say whether a repo's JSON has changed (and who may see it), without the repo's
+        entries. Returns a row of (is_private, version, updated_at, last_visited), or None if the repo doesn't exist. """
+        return db.session.query(cls.is_private, cls.version, cls.updated_at, cls.last_visited).filter(
+            cls.access_key == access_key
+        ).first()
 
-        return {
+    @classmethod
+    def idle(cls, cutoff):
+        """ Query of the repos last visited before cutoff (a date). """
+        return cls.query.filter(cls.last_visited < cutoff)
+
+    @classmethod
+    def cull(cls, cutoff, limit):
+        """ Deletes up to limit repos last visited before cutoff, longest idle first, with one DELETE ... RETURNING. Their
+        entries go with them through the foreign key's ON DELETE CASCADE. Repos row-locked by a request in progress are
+        skipped rather than waited on. Returns the deleted access keys, without committing. """
+        table = cls.__table__
+        idle = select(table.c.access_key).where(table.c.last_visited < cutoff).order_by(
+            table.c.last_visited
+        ).limit(limit).with_for_update(skip_locked=True)
+        stmt = table.delete().where(table.c.access_key.in_(idle)).returning(table.c.access_key)
+        return [access_key for (access_key,) in db.session.execute(stmt)]
+
+    def to_json(self, summary=False):
+        """ The repo's JSON, with all of its entries. A summary has only the number of entries instead, for clients that
+        page through them at /api/repo/<access_key>/entries. """
+        json = {
             "access_key" : self.access_key,
             "title" : self.title,
             "description" : self.description,
             "is_private" : self.is_private,
             "last_visited" : str(self.last_visited),
-            "entries" : entries
+            "version" : self.version,
         }
+        if summary:
+            json["entry_count"] = Entry.query.filter(Entry.repo_access_key == self.access_key).count()
+        else:
+            json["entries"] = Entry.json_for_repo(self.access_key)
+        return json
 
 
 class Entry(db.Model):
@@ -79,6 +157,14 @@ class Entry(db.Model):
     rating = db.Column(db.Integer)
     sequence = db.Column(db.Integer)
     repo_access_key = db.Column(db.Text, db.ForeignKey('repos.access_key', ondelete="CASCADE"), nullable=False)
+    # Set while the entry waits on a background scrape for its metadata
+    scrape_job_id = db.Column(db.Integer, db.ForeignKey('scrape_jobs.id', ondelete="SET NULL"))
+
+    __table_args__ = (
+        # Every repo load, ownership check and cascade filters on repo_access_key, and entries are read in sequence order
+        db.Index('ix_entries_repo_sequence', 'repo_access_key', 'sequence', 'id'),
+        db.Index('ix_entries_scrape_job_id', 'scrape_job_id', postgresql_where=db.text('scrape_job_id IS NOT NULL')),
+    )
 
     type_to_string = {
         EntryType.link : 'link',
@@ -86,6 +172,149 @@ class Entry(db.Model):
         EntryType.text_box : 'text_box'
     }
 
+    # Fields a client may change on an existing entry
+    EDITABLE = ('title', 'description', 'image', 'url', 'type', 'rating', 'sequence')
+    # Rows per UPDATE ... FROM (VALUES ...) statement, keeping the number of bound parameters well under Postgres' limit
+    BULK_CHUNK = 1000
+
+    @classmethod
+    def owners(cls, ids):
+        """ Maps each of the given entry ids that exists to the access key of the repo it belongs to. """
+        return dict(db.session.query(cls.id, cls.repo_access_key).filter(cls.id.in_(ids)))
+
+    @classmethod
+    def editable_rows(cls, access_key, ids):
+        """ Loads the editable fields of the given entries of a repo with one query, as {id : {field : value}}.
+        Ids that don't exist or belong to another repo are left out. The rows are locked until the transaction ends:
+        bulk_update writes back every editable field from this snapshot, so a concurrent write (such as a scrape job
+        filling in metadata) must wait for it rather than be overwritten. Locked in id order, so overlapping edits can't
+        deadlock. """
+        query = db.session.query(cls.id, *[getattr(cls, field) for field in cls.EDITABLE]).filter(
+            cls.id.in_(ids), cls.repo_access_key == access_key
+        ).order_by(cls.id).with_for_update()
+        return {row.id : row._asdict() for row in query}
+
+    @classmethod
+    def bulk_update(cls, rows, changes):
+        """ Applies partial updates ({'id' : Integer, field : new value, ...}) on top of rows loaded by editable_rows,
+        writing every changed row back with a single UPDATE ... FROM (VALUES ...) statement per BULK_CHUNK rows. """
+        changed = {}
+        for change in changes:
+            row = changed.setdefault(change['id'], rows[change['id']])
+            for field in cls.EDITABLE:
+                if field in change:
+                    row[field] = change[field]
+
+        table = cls.__table__
+        fields = ('id',) + cls.EDITABLE
+        changed = list(changed.values())
+        for i in range(0, len(changed), cls.BULK_CHUNK):
+            data = values(*[column(field, table.c[field].type) for field in fields], name='changed').data(
+                [tuple(row[field] for field in fields) for row in changed[i:i + cls.BULK_CHUNK]]
+            )
+            db.session.execute(
+                table.update().where(table.c.id == data.c.id).values(
+                    {field : cast(data.c[field], table.c[field].type) for field in cls.EDITABLE}
+                )
+            )
+
+    @classmethod
+    def bulk_insert(cls, access_key, entries):
+        """ Creates entries ({field : value} of the EDITABLE fields, plus an optional scrape_job_id) on a repo with one
+        INSERT ... SELECT FROM unnest(...) per BULK_CHUNK entries, each field's values bound as a single array. Unlike a
+        multi-row VALUES list, the statement is the same for any number of entries, so SQLAlchemy compiles it once.
+        Returns the (id, sequence) of each created entry, in the order given. """
+        table = cls.__table__
+        fields = cls.EDITABLE + ('scrape_job_id',)
+        # Enum values are bound as text and cast back per row
+        array_types = {field : db.Text if field == 'type' else table.c[field].type for field in fields}
+        arrays = [bindparam(field, type_=ARRAY(array_types[field])) for field in fields]
+        rows = func.unnest(*arrays).table_valued(*fields, with_ordinality='position').render_derived(name='new_entries')
+        stmt = insert(table).from_select(
+            fields + ('repo_access_key',),
+            select(
+                *[cast(rows.c[field], table.c[field].type) for field in fields], bindparam('access_key', type_=db.Text)
+            ).order_by(rows.c.position)
+        ).returning(table.c.id, table.c.sequence)
+
+        created = []
+        for i in range(0, len(entries), cls.BULK_CHUNK):
+            chunk = entries[i:i + cls.BULK_CHUNK]
+            params = {field : [entry.get(field) for entry in chunk] for field in fields}
+            params['type'] = [cls.type_to_string.get(entry['type'], entry['type']) for entry in chunk]
+            # Ids come from the table's sequence in insert order, which follows position
+            created.extend(sorted(
+                (tuple(row) for row in db.session.execute(stmt, dict(params, access_key=access_key))),
+                key=lambda row: row[0]
+            ))
+        return created
+
+    @classmethod
+    def next_sequence(cls, access_key):
+        """ The sequence following a repo's last entry, i.e. that of an entry appended to the end of the repo. """
+        last = db.session.query(func.max(cls.sequence)).filter(cls.repo_access_key == access_key).scalar()
+        return 0 if last is None else last + 1
+
+    @classmethod
+    def bulk_delete(cls, access_key, ids):
+        """ Deletes the given entries of a repo with a single statement, returning the set of ids that were deleted.
+        Ids that don't exist or belong to another repo are left alone. """
+        table = cls.__table__
+        ids = cast(bindparam('ids', list(ids), type_=ARRAY(db.Integer)), ARRAY(db.Integer))
+        stmt = table.delete().where(table.c.id == any_(ids)).where(table.c.repo_access_key == access_key)
+        return {id for (id,) in db.session.execute(stmt.returning(table.c.id))}
+
+    @classmethod
+    def json_for_repo(cls, access_key, after=None, limit=None):
+        """ JSON-serialized entries of a repo, ordered by sequence. Built straight from a single column-only query's row
+        tuples, which is much cheaper than loading and serializing each Entry object for large repos.
+        For a page of entries, after is the (sequence, id) of the entry before the page (None to start from the first),
+        which keeps every page an index range scan however deep it is, unlike an OFFSET. """
+        query = db.select(
+            [cls.id, cls.title, cls.description, cls.image, cls.url, cls.type, cls.rating, cls.sequence]
+        ).where(cls.repo_access_key == access_key).order_by(cls.sequence, cls.id)
+
+        if after is None:
+            rows = db.session.execute(query.limit(limit)).fetchall()
+        elif after[0] is None:
+            rows = db.session.execute(query.where(cls.sequence.is_(None), cls.id > after[1]).limit(limit)).fetchall()
+        else:
+            # Postgres sorts NULLs last, so entries without a sequence follow the rest. They're fetched separately, as
+            # OR-ing them into the row comparison would turn the index range into a filter over the whole repo
+            rows = db.session.execute(query.where(tuple_(cls.sequence, cls.id) > after).limit(limit)).fetchall()
+            if limit is None or len(rows) < limit:
+                rest = None if limit is None else limit - len(rows)
+                rows += db.session.execute(query.where(cls.sequence.is_(None)).limit(rest)).fetchall()
+
+        return list(cls.json_from_rows(rows))
+
+    @classmethod
+    def stream_for_repo(cls, access_key, batch_size=500):
+        """ Generates the JSON-serialized entries of a repo in sequence order, like json_for_repo, but reads them through
+        a server-side cursor batch_size rows at a time, so memory use stays flat however large the repo is. """
+        query = db.session.query(
+            cls.id, cls.title, cls.description, cls.image, cls.url, cls.type, cls.rating, cls.sequence
+        ).filter(cls.repo_access_key == access_key).order_by(cls.sequence, cls.id).yield_per(batch_size)
+        return cls.json_from_rows(query)
+
+    @classmethod
+    def json_from_rows(cls, rows):
+        """ Generates entry JSON from (id, title, description, image, url, type, rating, sequence) row tuples. """
+        type_to_string = cls.type_to_string
+        return (
+            {
+                "id" : id,
+                "title" : title,
+                "description" : description,
+                "image" : image,
+                "url" : url,
+                "type" : type_to_string[type],
+                "rating" : rating,
+                "sequence" : sequence,
+            }
+            for id, title, description, image, url, type, rating, sequence in rows
+        )
+
     def to_json(self):
         return {
             "id" : self.id,
@@ -98,6 +327,177 @@ class Entry(db.Model):
             "sequence" : self.sequence,
         }
 
+class ScrapeCache(db.Model):
+    """ Shared tier of scrape.tag_cache: scraped metadata keyed by normalized URL, visible to every worker process.
+    Reads and writes go through their own short-lived connections so they never touch the request's session. """
+    __tablename__ = 'scrape_cache'
+    ## Columns
+    url = db.Column(db.Text, primary_key=True)
+    data = db.Column(db.JSON, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def fetch(cls, url):
+        query = db.select([cls.data, cls.expires_at]).where(cls.url == url).where(cls.expires_at > datetime.utcnow())
+        try:
+            with db.engine.connect() as conn:
+                row = conn.execute(query).first()
+        except SQLAlchemyError:
+            return None
+        if row is None:
+            return None
+        return row.data, row.expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+    @classmethod
+    def save(cls, url, data, expires_at):
+        expires_at = datetime.utcfromtimestamp(expires_at)
+        stmt = insert(cls.__table__).values(url=url, data=data, expires_at=expires_at)
+        stmt = stmt.on_conflict_do_update(index_elements=['url'], set_={'data' : data, 'expires_at' : expires_at})
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(stmt)
+        except SQLAlchemyError:
+            pass
+
+    @classmethod
+    def discard(cls, url):
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(cls.__table__.delete().where(cls.url == url))
+        except SQLAlchemyError:
+            pass
+
+    @classmethod
+    def purge(cls, limit):
+        """ Deletes up to limit expired rows, which fetch already ignores, skipping any locked by a concurrent save.
+        Returns how many were deleted, without committing. """
+        table = cls.__table__
+        expired = select(table.c.url).where(table.c.expires_at < datetime.utcnow()).limit(limit).with_for_update(skip_locked=True)
+        return db.session.execute(table.delete().where(table.c.url.in_(expired))).rowcount
+
+
+class ScrapeJob(db.Model):
+    """ A queued scrape, resolved by worker.py. Only one job per URL is pending or running at a time; entries created
+    with just a URL point at their job and get its metadata written back once it completes. """
+    __tablename__ = 'scrape_jobs'
+    ## Columns
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    url = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Enum(JobStatus), nullable=False, default=JobStatus.pending)
+    result = db.Column(db.JSON)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ux_scrape_jobs_active_url', 'url', unique=True, postgresql_where=db.text("status IN ('pending', 'running')")),
+        # Workers claim the oldest unfinished job
+        db.Index('ix_scrape_jobs_queue', 'id', postgresql_where=db.text("status IN ('pending', 'running')")),
+    )
+
+    ## Relationships
+    entries = db.relationship('Entry', backref='scrape_job')
+
+    # A running job whose worker hasn't finished within LEASE seconds is assumed dead and handed out again
+    LEASE = int(os.environ.get('SCRAPE_JOB_LEASE', 60))
+    MAX_ATTEMPTS = 3
+
+    @classmethod
+    def enqueue(cls, url):
+        """ Returns the in-flight job for url, creating it if there isn't one. """
+        return cls.query.get(cls.enqueue_many([url])[url])
+
+    @classmethod
+    def enqueue_many(cls, urls):
+        """ Maps each URL to the id of its in-flight job, creating the jobs that don't exist yet. Takes one INSERT ...
+        ON CONFLICT DO NOTHING for the whole list, plus one query for the URLs that already had a job. A job that
+        finishes between the two is no longer in flight, so its URL goes round again and gets a new one. """
+        jobs = {}
+        missing = list(dict.fromkeys(urls))
+        while missing:
+            stmt = insert(cls.__table__).values([
+                {'url' : url, 'status' : JobStatus.pending.name, 'attempts' : 0} for url in missing
+            ]).on_conflict_do_nothing(
+                index_elements=['url'], index_where=db.text("status IN ('pending', 'running')")
+            ).returning(cls.id, cls.url)
+            jobs.update({url : id for id, url in db.session.execute(stmt)})
+
+            existing = [url for url in missing if url not in jobs]
+            if existing:
+                jobs.update({url : id for id, url in db.session.query(cls.id, cls.url).filter(
+                    cls.url.in_(existing), cls.status.in_([JobStatus.pending, JobStatus.running])
+                )})
+            missing = [url for url in missing if url not in jobs]
+        return jobs
+
+    @classmethod
+    def purge(cls, cutoff, limit):
+        """ Deletes up to limit done or failed jobs last updated before cutoff, skipping any locked by a worker.
+        Returns how many were deleted, without committing. """
+        table = cls.__table__
+        finished = select(table.c.id).where(
+            table.c.status.in_([JobStatus.done, JobStatus.failed]), table.c.updated_at < cutoff
+        ).limit(limit).with_for_update(skip_locked=True)
+        return db.session.execute(table.delete().where(table.c.id.in_(finished))).rowcount
+
+    @classmethod
+    def claim(cls):
+        """ Takes the oldest job that is pending (or whose worker died) and marks it running. Concurrent workers skip
+        rows locked by each other, so a job is only ever claimed once. """
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=cls.LEASE)
+        job = cls.query.filter(
+            or_(cls.status == JobStatus.pending, and_(cls.status == JobStatus.running, cls.updated_at < stale))
+        ).order_by(cls.id).with_for_update(skip_locked=True).first()
+
+        if job is None:
+            db.session.rollback()
+            return None
+        if job.attempts >= cls.MAX_ATTEMPTS:
+            job.fail()
+            return cls.claim()
+
+        job.status = JobStatus.running
+        job.attempts += 1
+        job.updated_at = now
+        db.session.commit()
+        return job
+
+    def complete(self, tags):
+        """ Stores the scraped tags and writes them back to waiting entries, without overwriting anything a user has
+        edited since (an entry's title is only replaced while it is still its URL). """
+        title = tags.get('title') or tags.get('site_name') or None
+        # Written back entries change their repos' JSON, but not their version, as no user edit can be overwritten
+        Repo.query.filter(
+            Repo.access_key.in_(db.session.query(Entry.repo_access_key).filter(Entry.scrape_job_id == self.id))
+        ).update({Repo.updated_at : func.now()}, synchronize_session=False)
+        Entry.query.filter(Entry.scrape_job_id == self.id).update({
+            Entry.title : case([(Entry.title == Entry.url, func.coalesce(title, Entry.title))], else_=Entry.title),
+            Entry.description : func.coalesce(func.nullif(Entry.description, ''), tags.get('description') or None),
+            Entry.image : func.coalesce(Entry.image, tags.get('image') or None),
+            Entry.scrape_job_id : None
+        }, synchronize_session=False)
+
+        self.status = JobStatus.done
+        self.result = tags
+        self.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def fail(self):
+        Entry.query.filter(Entry.scrape_job_id == self.id).update({Entry.scrape_job_id : None}, synchronize_session=False)
+        self.status = JobStatus.failed
+        self.updated_at = datetime.utcnow()
+        db.session.commit()
+
+    def to_json(self):
+        return {
+            "id" : self.id,
+            "url" : self.url,
+            "status" : self.status.name,
+            "data" : self.result
+        }
+
+
 def connect_db(flask_app):
     """Connects database to Flask app, import and call in app.py"""
     db.app = flask_app
@@ -0,0 +1,65 @@
+""" Opt-in request profiling for production. A PROFILE_SAMPLE_RATE fraction of requests to the PROFILE_ENDPOINTS (e.g.
+"api_repo_get,api_scrape_url") runs under cProfile, as does any request carrying an 'X-Profile: <PROFILE_TOKEN>' header.
+Each profile is written to PROFILE_DIR as a pstats file named after its endpoint, to be read with
+`python -m pstats <file>` or a viewer such as snakeviz. Everything is off unless PROFILE_ENDPOINTS or PROFILE_TOKEN is set. """
+import cProfile
+import hmac
+import os
+import random
+import tempfile
+import threading
+import time
+from flask import g, request
+
+ENDPOINTS = {endpoint.strip() for endpoint in os.environ.get('PROFILE_ENDPOINTS', '').split(',') if endpoint.strip()}
+SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'linkbin-profiles'))
+TOKEN = os.environ.get('PROFILE_TOKEN')
+# Most profiles each process writes, so a forgotten setting can't fill the disk
+MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 1000))
+
+_written = 0
+_lock = threading.Lock()
+
+def should_profile():
+    """ Whether the current request is to be profiled: asked for with the admin token, or sampled. """
+    if TOKEN and hmac.compare_digest(request.headers.get('X-Profile', ''), TOKEN):
+        return True
+    return request.endpoint in ENDPOINTS and random.random() < SAMPLE_RATE
+
+def _reserve_file():
+    global _written
+    with _lock:
+        if _written >= MAX_FILES:
+            return False
+        _written += 1
+        return True
+
+def init_app(app):
+    @app.before_request
+    def start_profile():
+        if not (ENDPOINTS or TOKEN) or not should_profile() or not _reserve_file():
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running on this thread
+            return
+        g.profiler = profiler
+        g.profile_file = f"{request.endpoint or 'unmatched'}-{int(time.time() * 1000)}-{os.getpid()}-{threading.get_ident()}.prof"
+
+    @app.after_request
+    def name_profile(response):
+        if 'profiler' in g:
+            response.headers['X-Profile-File'] = g.profile_file
+        return response
+
+    @app.teardown_request
+    def write_profile(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        os.makedirs(DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(DIR, g.profile_file))
@@ -1,15 +1,98 @@
 import requests
-from urllib.parse import unquote, urlparse, quote
-from requests.exceptions import ConnectionError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import unquote, urlparse, urlunparse, quote
+from requests.exceptions import ConnectionError, Timeout, RequestException
+from cache import TieredCache
+from metrics import SCRAPE_LATENCY, OPENGRAPH_FALLBACKS
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import deque
+from contextlib import contextmanager
+import threading
+import codecs
+import html
+import logging
+import http.client
+import re
+import socket
+import time
 import os
 
 TOKEN = os.environ.get('OPENGRAPH_API_KEY', 'KEY')
 
+logger = logging.getLogger('linkbin.scrape')
+
+# Scraped tags are cached by normalized URL. Failed connections are cached too (negatively), but for a shorter time.
+# app.py plugs a shared store (models.ScrapeCache) into tag_cache so every worker process benefits from each scrape.
+TAG_TTL = int(os.environ.get('SCRAPE_CACHE_TTL', 60 * 60 * 24))
+FAILURE_TTL = int(os.environ.get('SCRAPE_FAILURE_TTL', 60 * 5))
+tag_cache = TieredCache(max_size=int(os.environ.get('SCRAPE_CACHE_SIZE', 2048)))
+
+# Batch scrapes share one bounded thread pool per process. Each batch also caps how many of its URLs may hit the
+# same host at once (the rest wait in a per-host queue, off the pool), and gives up on whatever hasn't resolved by its
+# deadline.
+BATCH_WORKERS = int(os.environ.get('SCRAPE_BATCH_WORKERS', 16))
+BATCH_PER_HOST = int(os.environ.get('SCRAPE_BATCH_PER_HOST', 4))
+BATCH_DEADLINE = float(os.environ.get('SCRAPE_BATCH_DEADLINE', 20))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='scrape')
+
+# Pages are streamed and only read up to the end of their <head>, which is all the metadata we need. These bound how
+# long a single fetch may take and how much of a page we are willing to download.
+CONNECT_TIMEOUT = float(os.environ.get('SCRAPE_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('SCRAPE_READ_TIMEOUT', 5))
+TOTAL_TIMEOUT = float(os.environ.get('SCRAPE_TOTAL_TIMEOUT', 10))
+MAX_BYTES = int(os.environ.get('SCRAPE_MAX_BYTES', 512 * 1024))
+CHUNK_SIZE = 16 * 1024
+IMAGE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+# Once the head is parsed, a response's remainder is still read if it is this small, so its connection can be reused
+DRAIN_BYTES = 64 * 1024
+
+# All outbound requests reuse keep-alive connections from one set of per-host pools per process. requests.Session isn't
+# thread-safe, so each thread gets its own Session, but every Session is mounted on the same (thread-safe) adapter.
+POOL_HOSTS = int(os.environ.get('SCRAPE_POOL_HOSTS', 64))
+POOL_SIZE = int(os.environ.get('SCRAPE_POOL_SIZE', 8))
+RETRIES = int(os.environ.get('SCRAPE_RETRIES', 2))
+http_adapter = HTTPAdapter(
+    pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE,
+    max_retries=Retry(
+        total=RETRIES, backoff_factor=0.25, status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET']), raise_on_status=False, respect_retry_after_header=False
+    )
+)
+_local = threading.local()
+
+def http_session():
+    """ The calling thread's pooled requests.Session. """
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        session.mount('http://', http_adapter)
+        session.mount('https://', http_adapter)
+        _local.session = session
+    return session
+
+def pool_stats():
+    """ Per-host statistics of the shared connection pools: connections opened, requests sent over them, and how many
+    of the pool's slots are currently free (idle connections or room for new ones). """
+    pools = http_adapter.poolmanager.pools
+    stats = {}
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+            "connections" : pool.num_connections,
+            "requests" : pool.num_requests,
+            "free" : pool.pool.qsize() if pool.pool else 0
+        }
+    return stats
+
 def opengraphIO_scrape(url:str):
-    print(f'OpenGraph API Call: {url}')
+    logger.info("OpenGraph API call: %s", url)
+    OPENGRAPH_FALLBACKS.inc()
     try:
         endpoint = f'https://opengraph.io/api/1.1/site/{url}'
-        response = requests.get(endpoint, params={'app_id' : TOKEN}).json()
+        response = http_session().get(endpoint, params={'app_id' : TOKEN}, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)).json()
         return response['hybridGraph']
     except:
         return {}
@@ -17,85 +100,287 @@ def opengraphIO_scrape(url:str):
 def incomplete(tags):
     return (('title' not in tags) or ('description' not in tags) or ('image' not in tags) or ('url' not in tags))
 
-def get_tags(url:str):
-    """ Attempts to get the OpenGraph tags of a given URL, using the homebrew request parser. If tags are missing,
-    opengraph.io's API is utilized to plug the gaps."""
-    p_url = unquote(url)
-    pr = urlparse(p_url)
-    tags = {}
+def normalize_url(url:str):
+    """ Canonical form of an absolute URL for use as a cache key: scheme and host are lower-cased, the fragment is dropped. """
+    pr = urlparse(url)
+    return urlunparse((pr.scheme.lower(), pr.netloc.lower(), pr.path, pr.params, pr.query, ''))
 
-    # Missing/incorrect schema
-    if not pr.scheme :
+def resolve_url(url:str, quoted:bool=True):
+    """ The absolute URL to fetch for a URL as sent by a client, decoded if quoted (the front end percent-encodes the
+    URLs it sends) and with "http://" added if it has no scheme, along with the parse of the URL before that. """
+    p_url = unquote(url) if quoted else url
+    pr = urlparse(p_url)
+    if not pr.scheme:
         p_url = "http://" + p_url
-    elif pr.scheme != 'http' and pr.scheme != 'https':
+    return p_url, pr
+
+def job_url(url:str, quoted:bool=True):
+    """ The form a URL is queued for the scrape worker in: its cache key, so equivalent URLs share a single job. """
+    return normalize_url(resolve_url(url, quoted)[0])
+
+def get_tags(url:str, fetch:bool=True, quoted:bool=True):
+    """ Attempts to get the OpenGraph tags of a given URL, using the homebrew request parser. If tags are missing,
+    opengraph.io's API is utilized to plug the gaps. Results are served from tag_cache when possible.
+    With fetch=False only the cache is consulted, and None is returned when the URL would need scraping.
+    With quoted=False the URL is taken as is, rather than percent-decoded first."""
+    p_url, pr = resolve_url(url, quoted)
+
+    # Incorrect schema
+    if pr.scheme and pr.scheme != 'http' and pr.scheme != 'https':
         return {'title' : pr.netloc} if pr.netloc else {'title': p_url}
 
-    try:
-        res = requests.get(p_url)
-        # Don't look for HTML data on images or non-HTML
-        if res.headers['content-type'] in {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}:
+    key = normalize_url(p_url)
+    tags = tag_cache.get(key)
+    if tags is None and not fetch:
+        return None
+    elif tags is None:
+        start = time.perf_counter()
+        try:
+            tags = scrape_tags(p_url, typed_url=not pr.scheme)
+            SCRAPE_LATENCY.labels('ok').observe(time.perf_counter() - start)
+            tag_cache.set(key, tags, TAG_TTL)
+        except (ConnectionError, Timeout):
+            SCRAPE_LATENCY.labels('error').observe(time.perf_counter() - start)
+            logger.info("Could not connect to %s", p_url)
+            tags = {'url' : p_url, 'description' : 'Sorry, we could not connect to this URL.'}
+            tag_cache.set(key, tags, FAILURE_TTL)
+
+    # Copy, so callers can't mutate the cached value
+    tags = dict(tags)
+    if not pr.scheme:
+        tags['url'] = p_url
+    return tags
+
+def get_tags_batch(urls:list, deadline:float=BATCH_DEADLINE):
+    """ Runs get_tags on many URLs concurrently. Returns a list of results in the same order as urls, each either
+    {'url' : url, 'data' : tags} or {'url' : url, 'error' : message}. URLs still pending after deadline seconds are
+    reported as timed out, so the whole batch takes about as long as its slowest fetch (or the deadline)."""
+    results = [Future() for url in urls]
+    queues = {}
+    for i, url in enumerate(urls):
+        queues.setdefault(url_host(url), deque()).append(i)
+    lock = threading.Lock()
+    expired = threading.Event()
+
+    def fetch_next(host):
+        # URLs wait in their host's queue, not on a pool thread, so a busy host never holds up the pool. Once a fetch
+        # finishes, the host's next URL is submitted to the back of the pool's queue, behind other hosts' work.
+        with lock:
+            if expired.is_set() or not queues[host]:
+                return
+            i = queues[host].popleft()
+        try:
+            results[i].set_result(get_tags(urls[i]))
+        except Exception as e:
+            results[i].set_exception(e)
+        if queues[host] and not expired.is_set():
+            batch_pool.submit(fetch_next, host)
+
+    for host, queue in queues.items():
+        for _ in range(min(BATCH_PER_HOST, len(queue))):
+            batch_pool.submit(fetch_next, host)
+    wait(results, timeout=deadline)
+    # URLs not yet started are dropped; fetches already in flight finish in the background and still fill the cache
+    expired.set()
+
+    batch = []
+    for url, result in zip(urls, results):
+        if not result.done():
+            batch.append({'url' : url, 'error' : 'Timed out'})
+        elif result.exception() is not None:
+            batch.append({'url' : url, 'error' : 'Could not retrieve metadata'})
+        else:
+            batch.append({'url' : url, 'data' : result.result()})
+    return batch
+
+def url_host(url:str):
+    """ Host name of a URL as typed by a user, which may be missing its scheme. """
+    p_url = unquote(url)
+    if '://' not in p_url:
+        p_url = 'http://' + p_url
+    return urlparse(p_url).netloc.lower()
+
+def scrape_tags(p_url:str, typed_url:bool=False):
+    """ Uncached scrape of an absolute http(s) URL. Raises ConnectionError or Timeout if the site can't be reached.
+    typed_url says the URL was given without a scheme, in which case p_url stands in as its url tag. """
+    # Uncompressed, so the head can be parsed as it arrives (see stream_body)
+    headers = {'Accept-Encoding' : 'identity'}
+    with http_session().get(p_url, stream=True, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as res:
+        content_type = res.headers.get('content-type', '')
+        # Don't look for HTML data on images or non-HTML, and don't download their bodies either
+        if content_type.partition(';')[0].strip() in IMAGE_TYPES:
             return {'title' : p_url, 'image' : p_url, 'url' : p_url}
-        elif 'text/html' in res.headers['content-type']:
-            tags = parse_HTML(res.text)
-            if not pr.scheme:
+        elif 'text/html' in content_type:
+            parser = MetaTagParser()
+            with cut_off(res, TOTAL_TIMEOUT) as expired:
+                try:
+                    received = feed_head(res, parser)
+                    # Closing a partially read response drops its connection; finish reading it instead if that's cheap
+                    length = res.headers.get('content-length', '')
+                    if length.isdigit() and int(length) - received <= DRAIN_BYTES:
+                        for chunk in res.iter_content(CHUNK_SIZE):
+                            pass
+                except RequestException:
+                    # Reading was cut off at the deadline, go with whatever was parsed by then
+                    if not expired.is_set():
+                        raise
+            tags = parser.tags()
+            if typed_url:
                 tags['url'] = p_url
-            # Make OpenGraph.io API call if we got a good connection but incomplete tags
-            if res.status_code == 200 and incomplete(tags):
-                og_tags = opengraphIO_scrape(quote(p_url, safe=''))
-                tags['title'] = og_tags.get('title', tags.get('title'))
-                tags['description'] = og_tags.get('description', tags.get('description'))
-                tags['image'] = og_tags.get('image', tags.get('image'))
-                tags['site_name'] = og_tags.get('site_name', tags.get('site_name'))
-            
-            return tags
         else:
             return {'title' : p_url}
-    except ConnectionError:
-        print('Connection Error')
-        return {'url' : p_url, 'description' : 'Sorry, we could not connect to this URL.'}
+
+    # Make OpenGraph.io API call if we got a good connection but incomplete tags
+    if res.status_code == 200 and incomplete(tags):
+        og_tags = opengraphIO_scrape(quote(p_url, safe=''))
+        tags['title'] = og_tags.get('title', tags.get('title'))
+        tags['description'] = og_tags.get('description', tags.get('description'))
+        tags['image'] = og_tags.get('image', tags.get('image'))
+        tags['site_name'] = og_tags.get('site_name', tags.get('site_name'))
+
+    return tags
+
+@contextmanager
+def cut_off(res, seconds):
+    """ Shuts down a streamed response's connection once seconds have passed, unless the block has finished by then.
+    The read timeout restarts with every byte received, so a page trickling in could otherwise be read for as long as
+    the server likes; shutting the socket down ends even a read that is blocked on it. Yields an Event that is set
+    if the response was cut off, after which reading it ends early or raises. """
+    expired = threading.Event()
+
+    def shut_down():
+        expired.set()
+        # The socket, as wrapped by the response's file: the connection lets go of it when it won't be reused
+        fp = getattr(res.raw._fp, 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None) or getattr(res.raw.connection, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    timer = threading.Timer(seconds, shut_down)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield expired
+    finally:
+        timer.cancel()
+
+def stream_body(res, size=CHUNK_SIZE):
+    """ Generates a streamed response's body as it arrives. iter_content waits for each chunk to fill up, so a page
+    whose head arrives promptly but whose body is slow would hold up parsing; here each chunk is whatever one read of
+    the connection returns, up to size bytes. A compressed body (sent despite asking for identity) is left to
+    iter_content to decode. Read errors are raised as ConnectionError, as iter_content would. """
+    if res.headers.get('content-encoding', 'identity').lower() != 'identity':
+        yield from res.iter_content(size)
+        return
+    try:
+        for chunk in iter(lambda: res.raw._fp.read1(size), b''):
+            yield chunk
+    except (http.client.HTTPException, OSError) as err:
+        raise ConnectionError(err)
+
+def feed_head(res, parser):
+    """ Decodes a streamed HTML response into parser, chunk by chunk, until the parser has seen the end of the <head>.
+    Stops early once MAX_BYTES have been read, leaving the parser with whatever was received. Returns the number of
+    bytes read. """
+    # requests assumes ISO-8859-1 when no charset is given, but that is rarely true of HTML in practice
+    encoding = res.encoding if 'charset' in res.headers.get('content-type', '') else 'utf-8'
+    try:
+        decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    except LookupError:
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    received = 0
+    for chunk in stream_body(res):
+        received += len(chunk)
+        parser.feed(decoder.decode(chunk))
+        if parser.done or received >= MAX_BYTES:
+            break
+    return received
+
+
+# Only the tags MetaTagParser cares about are tokenized; everything else in the document is skipped over by the regex engine
+META_TAG_RE = re.compile(r'<(/?)(meta|title|head|body)\b([^>]*)>', re.IGNORECASE)
+ATTRIBUTE_RE = re.compile(r'''([^\s=/>"']+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+))''')
+TITLE_END_RE = re.compile(r'</title\s*>', re.IGNORECASE)
+TITLE_MAX = 1024
+
+class MetaTagParser:
+    """ Single-pass, incremental scanner for the metadata in an HTML document's head: OpenGraph <meta property="og:...">
+    tags, the meta description and the <title>. Attributes may be in any order and single, double or un-quoted.
+    Text can be fed in as it arrives; done is set once the head has ended, after which the rest can be skipped. """
+
+    def __init__(self):
+        self.og = {}
+        self.title = None
+        self.description = None
+        self.done = False
+        self._buffer = ''
+
+    def feed(self, text):
+        if self.done:
+            return
+        buffer = self._buffer + text
+        pos = 0
+        keep = None
+        while not self.done:
+            match = META_TAG_RE.search(buffer, pos)
+            if match is None:
+                break
+            closing, name, attrs = match.group(1), match.group(2).lower(), match.group(3)
+            pos = match.end()
+
+            if name == 'meta' and not closing:
+                self.handle_meta(attrs)
+            elif name == 'title' and not closing and self.title is None:
+                end = TITLE_END_RE.search(buffer, pos)
+                if end is None and len(buffer) - pos < TITLE_MAX:
+                    # Title text continues in the next chunk, rescan from its opening tag then
+                    keep = match.start()
+                    break
+                title_end = end.start() if end else pos + TITLE_MAX
+                self.title = html.unescape(buffer[pos:title_end]).strip()
+                pos = end.end() if end else title_end
+            elif (name == 'head' and closing) or (name == 'body' and not closing):
+                self.done = True
+
+        if keep is None:
+            # Hold on to a trailing, possibly incomplete tag so it can be completed by the next chunk
+            rest = buffer.rfind('<', pos)
+            keep = rest if rest != -1 and buffer.find('>', rest) == -1 else len(buffer)
+        self._buffer = '' if self.done else buffer[keep:]
+
+    def handle_meta(self, attr_text):
+        attrs = {}
+        for match in ATTRIBUTE_RE.finditer(attr_text):
+            value = match.group(2) if match.group(2) is not None else match.group(3) if match.group(3) is not None else match.group(4)
+            attrs[match.group(1).lower()] = value
+
+        content = html.unescape(attrs.get('content', '')).strip()
+        prop = attrs.get('property', '')
+        if prop.startswith('og:') and prop[3:] and content:
+            self.og[prop[3:]] = content
+        elif attrs.get('name', '').lower() == 'description' and self.description is None:
+            self.description = content
+
+    def tags(self):
+        """ Dictionary of every OpenGraph tag found, with title and description falling back to the <title> tag and
+        meta description (or empty strings, if those are missing too). """
+        tags = dict(self.og)
+        if 'title' not in tags:
+            tags['title'] = self.title or ''
+        if 'description' not in tags:
+            tags['description'] = self.description or ''
+        return tags
 
 
 def parse_HTML(content):
     """ Parses the text of an HTML document for opengraph tags and returns a dictionary containing each found. """
-    tags = {}
-    remain = content
-    while (remain):
-        after = remain.partition('property="og:')[2]
-        y1 = after.find('/>')
-        y2 = after.find('>')
-        
-        if y1 == -1:
-            y = y2
-        elif y2 == -1:
-            y = y1
-        elif y1 < y2:
-            y = y1
-        else:
-            y = y2
-
-        meat = after[:y]
-        key = meat.partition('"')[0]
-        value = meat.partition('content="')[2]
-        value = value.strip('" ')
-        if key and value:
-            tags[key] = value
-        remain = after
-    
-    # grab meta description and title tag
-    if 'title' not in tags:
-        tags['title'] = content.partition('<title>')[2].partition('</title>')[0]
-    if 'description' not in tags:
-        desc = content.partition('<meta name="description" content="')[2]
-        y1 = desc.find('/>')
-        y2 = desc.find('>')
-        if y1 == -1:
-            y = y2
-        elif y2 == -1:
-            y = y1
-        elif y1 < y2:
-            y = y1
-        else:
-            y = y2
-
-        tags['description'] = desc[:y].strip(' "')
-    return tags
\ No newline at end of file
+    parser = MetaTagParser()
+    for i in range(0, len(content), CHUNK_SIZE):
+        parser.feed(content[i:i + CHUNK_SIZE])
+        if parser.done:
+            break
+    return parser.tags()
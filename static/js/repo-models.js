@@ -144,8 +144,9 @@ class Entry {
 }
 
 class Repo {
-    constructor({title, description, entries, access_key, is_private}){
+    constructor({title, description, entries = [], access_key, is_private, version}){
         this.title = title ;
+        this.version = version;
         this.description = description;
         this.accessKey = access_key;
         this.isPrivate = is_private;
@@ -182,6 +183,30 @@ class Repo {
         );
     }
 
+    // Adds entries loaded from the server to the end of the list, rendering just those
+    appendEntries(entries){
+        const entriesList = document.getElementById('repo-entries');
+        for (let data of entries){
+            const entry = new Entry(data, "ORIGINAL");
+            const index = this.entries.push(entry) - 1;
+            const div = document.createElement('div');
+            div.id = `entry_${index}`;
+            div.innerHTML = entry.generateMarkup(index);
+            entriesList.append(div);
+        }
+    }
+
+    // Loads the repo's entries from the server a page at a time, each page shown as soon as it arrives
+    async loadEntries(){
+        let after = null;
+        do {
+            const params = after === null ? {} : {after};
+            const res = await axios.get(`/api/repo/${this.accessKey}/entries`, {params});
+            this.appendEntries(res.data.entries);
+            after = res.data.next;
+        } while (after !== null);
+    }
+
     refreshEntryMarkup(entryIndex){
         const entryDiv = document.getElementById(`entry_${entryIndex}`);
         const entry = this.entries[entryIndex];
@@ -221,9 +246,52 @@ class Repo {
         
         const repo = this;
         axios.get('/api/scrape', { params: {'url' : encodeURIComponent(url)} }).then(
+            async function (response){
+                let metaData = response.data.data;
+                // Uncached URLs are scraped in the background, poll the job until it's resolved, backing off each time
+                if (response.status === 202){
+                    let job = response.data.job;
+                    let delay = 500;
+                    while (job.status === 'pending' || job.status === 'running'){
+                        await new Promise( (resolve) => setTimeout(resolve, delay) );
+                        delay = Math.min(delay * 2, 5000);
+                        const poll = await axios.get(`/api/scrape/jobs/${job.id}`);
+                        job = poll.data;
+                    }
+                    metaData = job.data;
+                }
+                if (!metaData) return;
+                newEntry.updateWithMetaData(metaData);
+                // The entry may have been moved or deleted while waiting on the server
+                const idx = repo.entries.indexOf(newEntry);
+                if (idx !== -1) repo.refreshEntryMarkup(idx);
+            }
+        );
+    }
+
+    async addLinks(urls){
+        // Like addLink, but the metadata for every URL is scraped by the server in a single batch request
+        if (urls.length === 1) return this.addLink(urls[0]);
+
+        const newEntries = urls.map( (url) => {
+            const data = {id: null, title: url, description: null, image: null,
+                url: url, type: 'link', rating: null, sequence: this.entries.length}
+            const newEntry = new Entry(data, 'NEW');
+            this.entries.push(newEntry);
+            return newEntry;
+        });
+        this.refreshEntryList();
+
+        const repo = this;
+        axios.post('/api/scrape/batch', {'urls' : urls}).then(
             function (response){
-                newEntry.updateWithMetaData(response.data.data);
-                repo.refreshEntryMarkup(newEntryIdx);
+                response.data.data.forEach( (result, i) => {
+                    if (!result.data) return;
+                    newEntries[i].updateWithMetaData(result.data);
+                    // Entries may have been moved or deleted while waiting on the server
+                    const idx = repo.entries.indexOf(newEntries[i]);
+                    if (idx !== -1) repo.refreshEntryMarkup(idx);
+                });
             }
         );
     }
@@ -270,13 +338,6 @@ class Repo {
         }
     }
 
-    // Requests the API for updated entry information, usually called after committing new entries, as to get their IDs
-    async resyncEntries(){
-        const res = await axios.get(`/api/repo/${this.accessKey}`);
-        this.entries = res.data.entries.map( (entry) => new Entry(entry, "ORIGINAL"));
-        this.sortEntries();
-    }
-
     async commitRepoChanges(){
         const form = document.getElementById('repo-edit-form');
         this.title = form.repoTitle.value;
@@ -296,12 +357,14 @@ class Repo {
 
     async commitEntryChanges(){
         // parse repo changes and send to server
+        const added = [];
         const toAdd = [];
         const toChange = [];
         const toDelete = this.deleted;
         for (let entry of this.entries){
             switch (entry.state){
                 case 'NEW':
+                    added.push(entry);
                     toAdd.push(Entry.toJSON(entry));
                     break;
                 case 'CHANGE':
@@ -309,26 +372,38 @@ class Repo {
                     break;
             }
         }
-        const endPoint = `/api/repo/${this.accessKey}/entries`;
-        const requests = [];
-        // Send off requests in tandem
-        if (toAdd.length > 0){
-            requests.push(axios.post(endPoint, {'new' : toAdd}));
-        }
-        if (toChange.length > 0){
-            requests.push(axios.patch(endPoint, {'change' : toChange}));
-        }
-        if (toDelete.length > 0){
-            requests.push(axios.delete(endPoint, {data: {'delete' : toDelete}}));
-        }
-
+        // All edits go out in one request, applied by the server in a single transaction against the version we loaded
+        const changeset = {'version' : this.version, 'new' : toAdd, 'change' : toChange, 'delete' : toDelete};
         try{
-            await Promise.all(requests);
-            // If successful, resync entry data with server (mainly to get IDs for new entries)
+            const res = await axios.post(`/api/repo/${this.accessKey}/sync`, changeset);
+            // Server sends back the generated IDs in the same order the new entries were sent
+            res.data.created.forEach( ({id}, idx) => added[idx].id = id );
+            this.version = res.data.version;
             this.deleted = [];
-            await this.resyncEntries();
+            for (let entry of this.entries) entry.state = 'ORIGINAL';
         } catch (err) {
+            if (err.response && err.response.status === 409){
+                // Someone else saved this repo since we loaded it, nothing of ours was applied
+                throw {conflict : true, msg : err.response.data.error};
+            }
             throw `Could not save changes. Error msg: ${err}`;
         }
     }
+
+    hasUnsavedChanges(){
+        return this.deleted.length > 0 || this.entries.some( (entry) => entry.state !== 'ORIGINAL' );
+    }
+
+    // Uploads a Markdown link list or browser bookmarks file, which the server appends to the repo's entries
+    async importFile(file){
+        const form = new FormData();
+        form.append('file', file);
+        try{
+            const res = await axios.post(`/api/repo/${this.accessKey}/import`, form);
+            this.version = res.data.version;
+            return res.data.created.length;
+        } catch (err) {
+            throw err.response ? err.response.data.error : `Could not import file. Error msg: ${err}`;
+        }
+    }
 }
\ No newline at end of file
@@ -49,18 +49,24 @@ function toggleLoading(){
 /* Kickstarts the application by loading in repository information from the server */
 function loadRepoData(accessKey){
     toggleLoading();
-    axios.get(`/api/repo/${accessKey}`)
-    .then((res) => {
-        // Load in data from server
+    axios.get(`/api/repo/${accessKey}`, {params: {'summary' : 1}})
+    .then(async (res) => {
+        // Load in data from server, the repo info first and then its entries in pages
         const repo = new Repo(res.data);
         repo.displayRepoInfo();
         repo.refreshEntryList();
-        // Only bother with setting up editing listeners if we're authorized to edit
+        toggleLoading();
+        try {
+            await repo.loadEntries();
+        } catch (err) {
+            flash('Critical Error: Could not load repo entries.', 'danger');
+            return;
+        }
+        // Only bother with setting up editing listeners if we're authorized to edit, once every entry is in
         if (viewState === AUTH.edit){
             initEditEventListeners(repo);
             modalCloseHandlers();
         }
-        toggleLoading();
     })
     .catch((err) => {
         if ((err.response) && (err.response.status === 401 || err.response.status === 403)){
@@ -80,6 +86,7 @@ function initEditEventListeners(repo){
     const repoEditForm = document.getElementById('repo-edit-form');
     const repoDeleteForm = document.getElementById('repo-delete-form');
     const entryDeleteBtn = document.getElementById('btn-entry-delete');
+    const importFileInput = document.getElementById('input-import-file');
 
     controls.addEventListener('click', (evt) => {controlClickHandler(evt, repo)});
     entryList.addEventListener('click', (evt) => {entriesClickHandler(evt, repo)});
@@ -87,17 +94,15 @@ function initEditEventListeners(repo){
     entryEditForm.addEventListener('submit', (evt) => {entryEditSubmitHandler(evt, repo)});
     repoDeleteForm.addEventListener('submit', (evt) => {deleteConfirmationHandler(evt, repo)});
     
+    importFileInput.addEventListener('change', (evt) => {importFileHandler(evt, repo)});
+
     newLinkForm.addEventListener('submit', (evt) => {
         evt.preventDefault();
-        const links = newLinkForm.new.value;
-        let changesMade = false;
-        for (let link of links.split('\n')){
-            if (link){
-                repo.addLink(link);
-                changesMade = true;
-            }
+        const links = newLinkForm.new.value.split('\n').filter( (link) => link );
+        if (links.length > 0){
+            repo.addLinks(links);
+            alertSave();
         }
-        if (changesMade) alertSave();
         newLinkForm.new.value = '';
     });
 
@@ -120,6 +125,24 @@ function initEditEventListeners(repo){
 }
 
 
+/* Imports the chosen Markdown or bookmarks file, then reloads the page to show the added entries */
+function importFileHandler(evt, repo){
+    const file = evt.target.files[0];
+    evt.target.value = '';
+    if (!file) return;
+    toggleLoading();
+    repo.importFile(file)
+    .then( (count) => {
+        flash(`Imported ${count} entries.`, 'success');
+        window.location.reload();
+    })
+    .catch( (err) => {
+        console.error(err);
+        flash(`Import failed. ${err}`, 'danger');
+        toggleLoading();
+    });
+}
+
 /* Sets up event listeners to close each modal type */
 function modalCloseHandlers(){
     const repoModal = document.getElementById('repo-edit-div');
@@ -197,9 +220,20 @@ function controlClickHandler(evt, repo){
             })
             .catch( (err) => {
                 console.error(err);
-                flash("Server Error. Please try again later.", 'danger')
+                if (err.conflict){
+                    flash("This repo was changed elsewhere. Reload the page before saving again.", 'warning');
+                } else {
+                    flash("Server Error. Please try again later.", 'danger')
+                }
             });
             break;
+        case 'btn-import-file':
+            if (repo.hasUnsavedChanges()){
+                flash('Save your changes before importing.', 'warning');
+            } else {
+                document.getElementById('input-import-file').click();
+            }
+            break;
         case 'btn-edit-repo':
             document.getElementById('repo-edit-div').style.display = 'block';
             loadRepoIntoEditForm(repo);
@@ -1,12 +1,19 @@
+import csv
+import gzip
+import io
+import json
 import os
+import time
 from unittest import TestCase
-from models import db, Entry, Repo
+from models import db, Entry, Repo, ScrapeCache, ScrapeJob, JobStatus
 from flask import session
+from datetime import date, datetime, timedelta
 
 # Set db to testing db prior to app import
 os.environ['DATABASE_URI'] = "postgresql:///link-test"
 
 from app import app
+import hashing
 
 db.drop_all()
 db.create_all()
@@ -16,6 +23,7 @@ class APITestCase(TestCase):
         # Clean old data
         Entry.query.delete()
         Repo.query.delete()
+        ScrapeJob.query.delete()
 
         # New sample data
         repo = Repo(access_key='123abc', pass_phrase='password', title='Test Repo', description='Test Desc')
@@ -35,6 +43,100 @@ class APITestCase(TestCase):
         # Clean failed transactions
         db.session.rollback()
     
+    def test_scrape_batch(self):
+        """ POST of many URLs to scrape at once """
+        with app.test_client() as client:
+            endpoint = '/api/scrape/batch'
+            # Non-http(s) URLs resolve without any network access
+            data = {'urls' : ['ftp://files.example.com/a', 'mailto:someone@example.com']}
+
+            ### Unauthenticated ###
+            res = client.post(endpoint, json=data)
+            self.assertEqual(res.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+
+            ### Bad Data ###
+            res = client.post(endpoint, json={})
+            self.assertEqual(res.status_code, 400)
+            res = client.post(endpoint, json={'urls' : 'ftp://files.example.com'})
+            self.assertEqual(res.status_code, 400)
+            res = client.post(endpoint, json={'urls' : ['ftp://files.example.com', 5]})
+            self.assertEqual(res.status_code, 400)
+            res = client.post(endpoint, json={'urls' : ['ftp://x'] * (app.config['SCRAPE_BATCH_LIMIT'] + 1)})
+            self.assertEqual(res.status_code, 400)
+
+            ### Success ###
+            res = client.post(endpoint, json=data)
+            self.assertEqual(res.status_code, 200)
+            results = res.get_json()['data']
+            # One result per URL, in request order
+            self.assertEqual([r['url'] for r in results], data['urls'])
+            self.assertEqual(results[0]['data']['title'], 'files.example.com')
+            self.assertEqual(results[1]['data']['title'], 'mailto:someone@example.com')
+
+    def test_scrape_jobs(self):
+        """ Uncached scrapes are queued for the background worker, which also fills in entries created from a URL """
+        import worker
+        # Nothing listens on port 1, so the scrape fails fast without leaving the machine
+        url = 'http://127.0.0.1:1/job-test'
+        with app.test_client() as client:
+            ### Unauthenticated ###
+            res = client.get('/api/scrape', query_string={'url' : url})
+            self.assertEqual(res.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+
+            ### Queued, once per URL ###
+            res = client.get('/api/scrape', query_string={'url' : url})
+            self.assertEqual(res.status_code, 202)
+            job = res.get_json()['job']
+            self.assertEqual(job['status'], 'pending')
+
+            res = client.get('/api/scrape', query_string={'url' : url})
+            self.assertEqual(res.get_json()['job']['id'], job['id'])
+            # Equivalent URLs share the job, and percent-encoding sent by the front end is decoded just once
+            res = client.get('/api/scrape', query_string={'url' : 'HTTP://127.0.0.1:1/job-test#top'})
+            self.assertEqual(res.get_json()['job']['id'], job['id'])
+            res = client.get('/api/scrape', query_string={'url' : '127.0.0.1:1/a%2520b'})
+            self.assertEqual(ScrapeJob.query.get(res.get_json()['job']['id']).url, 'http://127.0.0.1:1/a%20b')
+
+            ### Entries created from a URL wait on the same job ###
+            res = client.post('/api/repo/123abc/entries', json={'new' : [{'type' : 'link', 'url' : url}]})
+            self.assertEqual(res.status_code, 201)
+            entry = Entry.query.filter_by(url=url).one()
+            self.assertEqual(entry.title, url)
+            self.assertEqual(entry.scrape_job_id, job['id'])
+
+            ### Polling ###
+            res = client.get('/api/scrape/jobs/-1')
+            self.assertEqual(res.status_code, 404)
+            res = client.get(f"/api/scrape/jobs/{job['id']}")
+            self.assertEqual(res.get_json()['status'], 'pending')
+
+            ### Worker ###
+            updated_at = Repo.revision('123abc').updated_at
+            self.assertTrue(worker.run_once())
+            self.assertTrue(worker.run_once())
+            self.assertFalse(worker.run_once())
+
+            res = client.get(f"/api/scrape/jobs/{job['id']}")
+            json = res.get_json()
+            self.assertEqual(json['status'], 'done')
+            self.assertEqual(json['data']['url'], url)
+
+            entry = Entry.query.filter_by(url=url).one()
+            self.assertEqual(entry.description, json['data']['description'])
+            self.assertIsNone(entry.scrape_job_id)
+            # Written back entries change the repo's JSON, and so its ETag
+            self.assertGreater(Repo.revision('123abc').updated_at, updated_at)
+
+            # Now cached
+            res = client.get('/api/scrape', query_string={'url' : url})
+            self.assertEqual(res.status_code, 200)
+
     def test_repo_get(self):
         """ GET of a public repo """
         with app.test_client() as client:
@@ -66,7 +168,219 @@ class APITestCase(TestCase):
             self.assertEqual(json['entries'][0]['description'], entry.description)
             self.assertEqual(json['entries'][0]['image'], entry.image)
             self.assertEqual(json['entries'][0]['url'], entry.url)
-    
+
+    def test_repo_get_conditional(self):
+        """ GET of an unchanged repo with its ETag in If-None-Match is answered with an empty 304 """
+        endpoint = '/api/repo/123abc'
+        with app.test_client() as client:
+            res = client.get(endpoint)
+            etag = res.headers['ETag']
+            self.assertIn('Last-Modified', res.headers)
+            self.assertIn('no-cache', res.headers['Cache-Control'])
+
+            res = client.get(endpoint, headers={'If-None-Match' : etag})
+            self.assertEqual(res.status_code, 304)
+            self.assertEqual(res.data, b'')
+            self.assertEqual(res.headers['ETag'], etag)
+
+            # Entry and repo edits both change the tag
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+            client.patch('/api/repo/123abc/entries', json={'change' : [{'id' : self.entry_id, 'title' : 'new title'}]})
+            res = client.get(endpoint, headers={'If-None-Match' : etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json()['entries'][0]['title'], 'new title')
+            self.assertNotEqual(res.headers['ETag'], etag)
+            etag = res.headers['ETag']
+
+            client.patch(endpoint, json={'title' : 'New Title'})
+            res = client.get(endpoint, headers={'If-None-Match' : etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json()['title'], 'New Title')
+
+            # Private repos are only revalidated by their editor
+            client.patch(endpoint, json={'is_private' : True})
+            res = client.get(endpoint)
+            self.assertIn('private', res.headers['Cache-Control'])
+            with client.session_transaction() as sess:
+                del sess['working_repo']
+            res = client.get(endpoint, headers={'If-None-Match' : res.headers['ETag']})
+            self.assertEqual(res.status_code, 401)
+
+    def test_repo_entries_pages(self):
+        """ GET of a repo's entries a page at a time, and of the repo's summary """
+        # Ties and missing sequences make the cursor carry both sequence and id
+        db.session.add_all([Entry(title=f"entry {i}", sequence=(i // 2 if i < 6 else None), repo_access_key='123abc') for i in range(9)])
+        db.session.commit()
+        everything = Entry.json_for_repo('123abc')
+
+        with app.test_client() as client:
+            ### Access ###
+            res = client.get('/api/repo/nope/entries')
+            self.assertEqual(res.status_code, 404)
+            res = client.get('/api/repo/private123/entries')
+            self.assertEqual(res.status_code, 401)
+
+            ### Bad Data ###
+            for bad in ({'limit' : 0}, {'limit' : 'ten'}, {'after' : 'garbage'}):
+                res = client.get('/api/repo/123abc/entries', query_string=bad)
+                self.assertEqual(res.status_code, 400)
+
+            ### Paging ###
+            entries, params = [], {'limit' : 2}
+            while True:
+                res = client.get('/api/repo/123abc/entries', query_string=params)
+                self.assertEqual(res.status_code, 200)
+                page = res.get_json()
+                entries.extend(page['entries'])
+                if page['next'] is None:
+                    break
+                params['after'] = page['next']
+            self.assertEqual(entries, everything)
+
+            # Pages are conditional too
+            res = client.get('/api/repo/123abc/entries', query_string=params, headers={'If-None-Match' : res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+
+            ### Summary ###
+            res = client.get('/api/repo/123abc', query_string={'summary' : 1})
+            json = res.get_json()
+            self.assertNotIn('entries', json)
+            self.assertEqual(json['entry_count'], 10)
+            self.assertEqual(json['title'], 'Test Repo')
+
+    def test_repo_export(self):
+        """ GET of a repo's export as Markdown, JSON Lines or CSV, compressed when accepted """
+        db.session.add_all([
+            Entry(title='Section [1]', type='divider', sequence=1, repo_access_key='123abc'),
+            Entry(title='Notes', description='Some text', type='text_box', sequence=2, repo_access_key='123abc')
+        ])
+        db.session.commit()
+        endpoint = '/api/repo/123abc/export'
+        with app.test_client() as client:
+            ### Access / Bad Data ###
+            res = client.get('/api/repo/private123/export')
+            self.assertEqual(res.status_code, 401)
+            res = client.get(endpoint, query_string={'format' : 'docx'})
+            self.assertEqual(res.status_code, 400)
+
+            ### Markdown ###
+            res = client.get(endpoint)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.mimetype, 'text/markdown')
+            self.assertIn('attachment', res.headers['Content-Disposition'])
+            self.assertEqual(res.get_data(as_text=True), (
+                "# Test Repo\n\nTest Desc\n\n"
+                "\n## Section \\[1\\]\n\n"
+                "**Notes**\n\nSome text\n\n"
+                "- [entry title](http://url.com) - entry desc\n"
+            ))
+
+            ### JSON Lines ###
+            res = client.get(endpoint, query_string={'format' : 'jsonl'})
+            lines = [json.loads(line) for line in res.get_data(as_text=True).splitlines()]
+            self.assertEqual(lines, Entry.json_for_repo('123abc'))
+
+            ### CSV, gzipped ###
+            res = client.get(endpoint, query_string={'format' : 'csv'}, headers={'Accept-Encoding' : 'gzip'})
+            self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+            rows = list(csv.DictReader(io.StringIO(gzip.decompress(res.data).decode('utf-8'))))
+            self.assertEqual([row['title'] for row in rows], ['Section [1]', 'Notes', 'entry title'])
+            self.assertEqual(rows[0]['type'], 'divider')
+
+    def test_repo_import(self):
+        """ POST of a Markdown or bookmarks file, appended to the repo's entries """
+        bookmarks = (
+            b'<!DOCTYPE NETSCAPE-Bookmark-file-1>\n<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n'
+            b'<DT><H3>Reading</H3>\n<DL><p>\n'
+            b'<DT><A HREF="http://a.com" ADD_DATE="1">A &amp; B</A>\n<DD>About A\n'
+            b'<DT><A HREF="place:sort=8">Recent</A>\n'
+            b'</DL><p>\n<DT><A HREF="http://b.com">B</A>\n</DL><p>\n'
+        )
+        endpoint = '/api/repo/123abc/import'
+        with app.test_client() as client:
+            ### Unauthorized / Bad Data ###
+            res = client.post(endpoint, data={'file' : (io.BytesIO(bookmarks), 'bookmarks.html')})
+            self.assertEqual(res.status_code, 401)
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+            res = client.post(endpoint, data={})
+            self.assertEqual(res.status_code, 400)
+            res = client.post(endpoint, data={'file' : (io.BytesIO(bookmarks), 'bookmarks.html'), 'format' : 'docx'})
+            self.assertEqual(res.status_code, 400)
+
+            ### Bookmarks ###
+            res = client.post(endpoint, data={'file' : (io.BytesIO(bookmarks), 'bookmarks.html')})
+            self.assertEqual(res.status_code, 201)
+            self.assertEqual(res.get_json()['version'], 1)
+            self.assertEqual([entry['sequence'] for entry in res.get_json()['created']], [0, 1, 2])
+            entries = Entry.json_for_repo('123abc')
+            self.assertEqual([(entry['type'], entry['title']) for entry in entries[:3]], [
+                ('divider', 'Reading'), ('link', 'A & B'), ('link', 'B')
+            ])
+            self.assertEqual(entries[1]['description'], 'About A')
+
+            ### Markdown round trip, appended after the bookmarks ###
+            exported = client.get('/api/repo/123abc/export').data
+            res = client.post(endpoint, data={'file' : (io.BytesIO(exported), '123abc.md')})
+            self.assertEqual(res.status_code, 201)
+            self.assertEqual(res.get_json()['created'][0]['sequence'], 3)
+            entries = Entry.json_for_repo('123abc')
+            fields = ('type', 'title', 'description', 'url')
+            self.assertEqual(
+                # The setUp entry has no sequence, so it is exported (and imported) last but still sorts last
+                [[entry[field] or None for field in fields] for entry in entries[3:7]],
+                [[entry[field] or None for field in fields] for entry in entries[:3] + entries[7:]]
+            )
+
+            ### Entry limit ###
+            limit = app.config['IMPORT_MAX_ENTRIES']
+            app.config['IMPORT_MAX_ENTRIES'] = 2
+            try:
+                res = client.post(endpoint, data={'file' : (io.BytesIO(bookmarks), 'bookmarks.html')})
+            finally:
+                app.config['IMPORT_MAX_ENTRIES'] = limit
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(len(Entry.json_for_repo('123abc')), 8)
+
+    def test_repo_response_cache(self):
+        """ Public repo JSON and viewer pages are served from the response cache until the repo changes """
+        with app.test_client() as client:
+            res = client.get('/api/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'MISS')
+            res = client.get('/api/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'HIT')
+            self.assertEqual(res.get_json()['entries'][0]['title'], 'entry title')
+
+            res = client.get('/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'MISS')
+            res = client.get('/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'HIT')
+            self.assertIn(b'Test Repo', res.data)
+
+            # Writes invalidate both
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+            client.patch('/api/repo/123abc', json={'title' : 'Renamed'})
+            client.patch('/api/repo/123abc/entries', json={'change' : [{'id' : self.entry_id, 'title' : 'new title'}]})
+            with client.session_transaction() as sess:
+                del sess['working_repo']
+
+            res = client.get('/api/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'MISS')
+            self.assertEqual(res.get_json()['entries'][0]['title'], 'new title')
+            res = client.get('/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'MISS')
+            self.assertIn(b'Renamed', res.data)
+
+            # Changes made outside of this process are caught by the repo's revision
+            Entry.query.filter_by(id=self.entry_id).update({'title' : 'elsewhere'})
+            Repo.bump_version('123abc')
+            db.session.commit()
+            res = client.get('/api/repo/123abc')
+            self.assertEqual(res.headers['X-Cache'], 'MISS')
+            self.assertEqual(res.get_json()['entries'][0]['title'], 'elsewhere')
+
     def test_repo_private_get(self):
         """ GET of a private repo """
         with app.test_client() as client:
@@ -104,6 +418,47 @@ class APITestCase(TestCase):
             res = client.get(endpoint)
             self.assertEqual(res.status_code, 200)
     
+    def test_cull_repos(self):
+        """ flask cull-repos deletes idle repos and their entries in batches """
+        last_year = date.today() - timedelta(days=365)
+        Repo.query.filter_by(access_key='123abc').update({'last_visited' : last_year})
+        db.session.add_all([Repo(access_key=f"idle{i}", pass_phrase='pw', last_visited=last_year) for i in range(5)])
+        db.session.commit()
+        runner = app.test_cli_runner()
+
+        ### Dry Run ###
+        result = runner.invoke(args=['cull-repos', '--days', '30', '--dry-run'])
+        self.assertIn('Would delete 6 repos with 1 entries', result.output)
+        self.assertEqual(Repo.query.count(), 7)
+
+        ### Batches ###
+        result = runner.invoke(args=['cull-repos', '--days', '30', '--batch-size', '4', '--sleep', '0'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Deleted 4/6 repos.', result.output)
+        self.assertIn('Deleted 6/6 repos.', result.output)
+        db.session.rollback()
+        self.assertEqual([repo.access_key for repo in Repo.query.all()], ['private123'])
+        self.assertIsNone(Entry.query.get(self.entry_id))
+
+    def test_purge_scrapes(self):
+        """ flask purge-scrapes deletes expired scrape cache entries and old finished scrape jobs in batches """
+        ScrapeCache.query.delete()
+        db.session.commit()
+        for i in range(5):
+            ScrapeCache.save(f"http://expired.com/{i}", {'title' : 'Old'}, time.time() - 60)
+        ScrapeCache.save('http://fresh.com', {'title' : 'New'}, time.time() + 60)
+        old = datetime.utcnow() - timedelta(days=2)
+        db.session.add_all([ScrapeJob(url=f"http://done.com/{i}", status=JobStatus.done, updated_at=old) for i in range(3)])
+        db.session.add(ScrapeJob(url='http://pending.com', status=JobStatus.pending, updated_at=old))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['purge-scrapes', '--batch-size', '2', '--sleep', '0'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Deleted 5 expired scrape cache entries and 3 finished scrape jobs.', result.output)
+        db.session.rollback()
+        self.assertEqual([row.url for row in ScrapeCache.query.all()], ['http://fresh.com'])
+        self.assertEqual([job.url for job in ScrapeJob.query.all()], ['http://pending.com'])
+
     def test_repo_delete(self):
         """ DELETE of a repo """
         with app.test_client() as client:
@@ -138,6 +493,30 @@ class APITestCase(TestCase):
             self.assertIsNone(Repo.query.get(key))
             self.assertNotIn('working_repo', session)
             self.assertNotIn(key, session.values())
+            self.assertNotIn('auth_proof', session)
+
+    def test_repo_auth_proof(self):
+        """ A pass phrase checked once is confirmed from the session's proof, without bcrypt """
+        app.config['WTF_CSRF_ENABLED'] = False
+        with app.test_client() as client:
+            try:
+                res = client.post('/api/repo/create', data={'pass_phrase' : 'password', 'title' : 'Proven'})
+            finally:
+                app.config['WTF_CSRF_ENABLED'] = True
+            key = res.get_json()['created']
+            with client.session_transaction() as sess:
+                self.assertEqual(sess['auth_proof']['key'], key)
+
+            # Swapping the stored hash for one bcrypt can't check leaves only the proof able to authenticate
+            repo = Repo.query.get(key)
+            with client.session_transaction() as sess:
+                sess['auth_proof'] = hashing.make_proof(app.config['SECRET_KEY'], key, 'unhashed', 'password')
+            repo.pass_phrase = 'unhashed'
+            db.session.commit()
+            res = client.delete(f"/api/repo/{key}", json={'pass_phrase' : 'wrong'})
+            self.assertEqual(res.status_code, 401)
+            res = client.delete(f"/api/repo/{key}", json={'pass_phrase' : 'password'})
+            self.assertEqual(res.status_code, 200)
     
     def test_repo_patch(self):
         """ PATCH of a repo """
@@ -305,6 +684,125 @@ class APITestCase(TestCase):
             entry = Entry.query.get(self.entry_id)
             self.assertEqual(entry.title, 'asdf title')
 
+    def test_create_entries_bulk(self):
+        """ POST request creating entries returns the new ids, in the order the entries were sent """
+        endpoint = '/api/repo/123abc/entries'
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+
+            ### Bad Data ###
+            # Nothing is created when any one entry is invalid
+            res = client.post(endpoint, json={'new' : [{'title' : 'ok', 'type' : 'link'}, {'title' : 'no'}]})
+            self.assertEqual(res.status_code, 400)
+            res = client.post(endpoint, json={'new' : [{'title' : 'ok', 'type' : 'link'}, {'title' : 'no', 'type' : 'flargen'}]})
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(Entry.query.filter_by(repo_access_key='123abc').count(), 1)
+
+            ### Success ###
+            new = [{'title' : f"bulk {i}", 'type' : 'link', 'sequence' : i} for i in range(1500)]
+            new.append({'type' : 'link', 'url' : 'http://127.0.0.1:1/bulk-test'})
+            res = client.post(endpoint, json={'new' : new})
+            self.assertEqual(res.status_code, 201)
+
+            created = res.get_json()['created']
+            self.assertEqual(len(created), 1501)
+            self.assertEqual([entry['sequence'] for entry in created[:-1]], list(range(1500)))
+            titles = dict(db.session.query(Entry.id, Entry.title).filter(Entry.id.in_([entry['id'] for entry in created])))
+            self.assertEqual([titles[entry['id']] for entry in created[:-1]], [entry['title'] for entry in new[:-1]])
+
+            # The entry created from a URL waits on a scrape job
+            entry = Entry.query.get(created[-1]['id'])
+            self.assertEqual(entry.title, 'http://127.0.0.1:1/bulk-test')
+            self.assertEqual(entry.scrape_job.url, 'http://127.0.0.1:1/bulk-test')
+
+    def test_repo_sync(self):
+        """ POST request applying a versioned changeset of new, changed and deleted entries in one transaction """
+        endpoint = '/api/repo/123abc/sync'
+        with app.test_client() as client:
+            ### Not Found ###
+            res = client.post('/api/repo/290jt3irgodifbmfbdxmgboidn/sync', json={'version' : 0})
+            self.assertEqual(res.status_code, 404)
+
+            ### Unauthenticated ###
+            res = client.post(endpoint, json={'version' : 0})
+            self.assertEqual(res.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+
+            ### Missing / Bad Data ###
+            res = client.post(endpoint, json={'new' : []})
+            self.assertEqual(res.status_code, 400)
+            res = client.post(endpoint, json={'version' : '0'})
+            self.assertEqual(res.status_code, 400)
+
+            # Nothing is applied when any one edit fails
+            res = client.post(endpoint, json={
+                'version' : 0, 'new' : [{'title' : 'new', 'type' : 'link'}],
+                'change' : [{'id' : self.p_entry_id, 'title' : 'yes'}]
+            })
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(Repo.query.get('123abc').version, 0)
+            self.assertIsNone(Entry.query.filter_by(title='new').first())
+
+            ### Success ###
+            second = Entry(title='second', repo_access_key='123abc')
+            db.session.add(second)
+            db.session.commit()
+            second_id = second.id
+
+            res = client.post(endpoint, json={
+                'version' : 0, 'new' : [{'title' : 'new', 'type' : 'link', 'sequence' : 2}],
+                'change' : [{'id' : self.entry_id, 'title' : 'changed'}], 'delete' : [second_id]
+            })
+            self.assertEqual(res.status_code, 200)
+            json = res.get_json()
+            self.assertEqual(json['version'], 1)
+            self.assertEqual(Entry.query.get(json['created'][0]['id']).title, 'new')
+            self.assertEqual(Entry.query.get(self.entry_id).title, 'changed')
+            self.assertIsNone(Entry.query.get(second_id))
+
+            ### Stale ###
+            # Edits through the per-operation endpoints also move the version on
+            res = client.patch('/api/repo/123abc/entries', json={'change' : [{'id' : self.entry_id, 'rating' : 5}]})
+            self.assertEqual(res.get_json()['version'], 2)
+
+            res = client.post(endpoint, json={'version' : 1, 'change' : [{'id' : self.entry_id, 'title' : 'stale'}]})
+            self.assertEqual(res.status_code, 409)
+            self.assertEqual(res.get_json()['version'], 2)
+            self.assertEqual(Entry.query.get(self.entry_id).title, 'changed')
+
+    def test_patch_entries_bulk(self):
+        """ PATCH of many entries at once only changes the given fields of each """
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+
+            second = Entry(title='second', url='http://second.com', repo_access_key='123abc', sequence=1)
+            db.session.add(second)
+            db.session.commit()
+            second_id = second.id
+
+            data = {'change' : [
+                {'id' : self.entry_id, 'sequence' : 1, 'type' : 'divider'},
+                {'id' : second_id, 'sequence' : 0, 'title' : 'first'}
+            ]}
+            res = client.patch('/api/repo/123abc/entries', json=data)
+            self.assertEqual(res.status_code, 200)
+
+            entry = Entry.query.get(self.entry_id)
+            self.assertEqual((entry.sequence, entry.title, entry.url), (1, 'entry title', 'http://url.com'))
+            self.assertEqual(Entry.type_to_string[entry.type], 'divider')
+            entry = Entry.query.get(second_id)
+            self.assertEqual((entry.sequence, entry.title, entry.url), (0, 'first', 'http://second.com'))
+
+            # A single bad entry rejects the whole change set
+            data = {'change' : [{'id' : self.entry_id, 'title' : 'changed'}, {'id' : second_id, 'title' : None}]}
+            res = client.patch('/api/repo/123abc/entries', json=data)
+            self.assertEqual(res.status_code, 400)
+            self.assertEqual(Entry.query.get(self.entry_id).title, 'entry title')
+
     def test_delete_entries(self):
         """ DELETE request to delete existing entries for a repo """
         with app.test_client() as client:
@@ -347,4 +845,33 @@ class APITestCase(TestCase):
             res = client.delete(endpoint, json={'delete' : [self.entry_id]})
             self.assertEqual(res.status_code, 200)
             self.assertIsNone(Entry.query.get(self.entry_id))
-            self.assertEqual(len(Repo.query.get('123abc').entries), 0)
\ No newline at end of file
+            self.assertEqual(len(Repo.query.get('123abc').entries), 0)
+
+    def test_delete_entries_bulk(self):
+        """ DELETE of many entries at once is all or nothing """
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['working_repo'] = '123abc'
+
+            entries = [Entry(title=f"entry {i}", repo_access_key='123abc') for i in range(3)]
+            db.session.add_all(entries)
+            db.session.commit()
+            ids = [entry.id for entry in entries]
+            endpoint = '/api/repo/123abc/entries'
+
+            ### Bad Data ###
+            res = client.delete(endpoint, json={'delete' : ids[0]})
+            self.assertEqual(res.status_code, 400)
+            res = client.delete(endpoint, json={'delete' : [ids[0], 'abc']})
+            self.assertEqual(res.status_code, 400)
+
+            # One foreign entry rolls back the rest
+            res = client.delete(endpoint, json={'delete' : ids + [self.p_entry_id]})
+            self.assertEqual(res.status_code, 403)
+            self.assertEqual(Entry.query.filter(Entry.id.in_(ids)).count(), 3)
+
+            ### Success ###
+            res = client.delete(endpoint, json={'delete' : ids})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(Entry.query.filter(Entry.id.in_(ids)).count(), 0)
+            self.assertIsNotNone(Entry.query.get(self.entry_id))
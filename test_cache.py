@@ -0,0 +1,90 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+from cache import LRUCache, TieredCache, DiskStore
+
+class DictStore:
+    """ Minimal shared store for exercising TieredCache """
+    def __init__(self):
+        self.data = {}
+
+    def fetch(self, key):
+        found = self.data.get(key)
+        if found and found[1] > time.time():
+            return found
+        return None
+
+    def save(self, key, value, expires_at):
+        self.data[key] = (value, expires_at)
+
+    def discard(self, key):
+        self.data.pop(key, None)
+
+class LRUCacheTestCase(TestCase):
+    def test_get_set(self):
+        cache = LRUCache(max_size=2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_eviction(self):
+        """ Least recently used key is evicted once max_size is exceeded """
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache()
+        cache.set('a', 1, ttl=-1)
+        cache.set('b', 2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(len(cache), 1)
+
+class TieredCacheTestCase(TestCase):
+    def test_shared_tier(self):
+        """ Values written by one cache should be visible to another sharing the same store """
+        store = DictStore()
+        writer = TieredCache(store=store)
+        reader = TieredCache(store=store)
+
+        writer.set('a', {'title' : 'A'}, ttl=60)
+        self.assertEqual(reader.get('a'), {'title' : 'A'})
+        self.assertEqual(reader.stats()['shared_hits'], 1)
+
+        # Promoted into the local tier
+        self.assertEqual(reader.local.get('a'), {'title' : 'A'})
+
+        writer.delete('a')
+        self.assertIsNone(writer.get('a'))
+        self.assertEqual(writer.stats()['shared_misses'], 1)
+
+class DiskStoreTestCase(TestCase):
+    def test_shared_files(self):
+        """ Entries saved by one store are fetched by another on the same directory, until they expire """
+        with tempfile.TemporaryDirectory() as directory:
+            writer = TieredCache(store=DiskStore(directory))
+            reader = TieredCache(store=DiskStore(directory))
+
+            writer.set('a', ['tag', 'payload'], ttl=60)
+            self.assertEqual(reader.get('a'), ['tag', 'payload'])
+
+            writer.delete('a')
+            self.assertIsNone(TieredCache(store=DiskStore(directory)).get('a'))
+
+            store = DiskStore(directory)
+            store.save('b', 'stale', time.time() - 1)
+            self.assertIsNone(store.fetch('b'))
+            self.assertEqual(os.listdir(directory), [])
@@ -0,0 +1,31 @@
+import time
+from unittest import TestCase
+import hashing
+from hashing import hash_password, check_password, hash_rounds, make_proof, check_proof
+
+class HashingTestCase(TestCase):
+    def test_check_password(self):
+        """ Hashes are checked in the hashing pool, and flagged for rehashing when made at another cost """
+        hashed = hash_password('pw')
+        self.assertEqual(hash_rounds(hashed), hashing.LOG_ROUNDS)
+        self.assertEqual(check_password('pw', hashed), (True, False))
+        self.assertEqual(check_password('pW', hashed), (False, False))
+        self.assertEqual(check_password('pw', 'not a hash'), (False, False))
+
+        cheap = hashing._hash('pw', 4)
+        self.assertEqual(check_password('pw', cheap), (True, True))
+        self.assertEqual(check_password('nope', cheap), (False, False))
+
+    def test_proof(self):
+        """ Proofs only confirm the pass phrase they were made for, on the same repo and hash, while fresh """
+        proof = make_proof('secret', 'abc', 'hash', 'pw')
+        self.assertNotIn('pw', proof.values())
+        self.assertTrue(check_proof(proof, 'secret', 'abc', 'hash', 'pw'))
+        self.assertFalse(check_proof(proof, 'secret', 'abc', 'hash', 'pW'))
+        self.assertFalse(check_proof(proof, 'secret', 'xyz', 'hash', 'pw'))
+        self.assertFalse(check_proof(proof, 'secret', 'abc', 'new hash', 'pw'))
+        self.assertFalse(check_proof(proof, 'other secret', 'abc', 'hash', 'pw'))
+        self.assertFalse(check_proof(None, 'secret', 'abc', 'hash', 'pw'))
+
+        proof['at'] = int(time.time()) - hashing.PROOF_TTL - 1
+        self.assertFalse(check_proof(proof, 'secret', 'abc', 'hash', 'pw'))
@@ -0,0 +1,100 @@
+import io
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from imports import read_text, lines, parse_markdown, parse_bookmarks, guess_format, batches, mark_for_enrichment, enrich
+
+class ReadOnlyStream:
+    """ Offers nothing but read(), like the SpooledTemporaryFile Werkzeug stores uploads in before Python 3.11 """
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+
+    def read(self, size=-1):
+        return self._data.read(size)
+
+def chunked(text, size=7):
+    """ Splits text into small chunks, as the parsers would read a large upload """
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+class ImportsTestCase(TestCase):
+    def test_read_text(self):
+        """ Uploads are decoded in chunks, replacing invalid UTF-8 """
+        stream = io.BytesIO('héllo\r\nwörld\rend\n'.encode('utf-8') + b'\xff')
+        self.assertEqual(list(lines(read_text(stream, chunk_size=3))), ['héllo', 'wörld', 'end', '\ufffd'])
+
+        # Any chunking, including CRLFs and multi-byte characters split between reads, of a stream without readable()
+        data = 'a\r\nb\rc\r\n\r\nd\r'.encode('utf-8') + 'é\r'.encode('utf-8')
+        for size in (1, 2, 3, 5):
+            text = ''.join(read_text(ReadOnlyStream(data), chunk_size=size))
+            self.assertEqual(text, 'a\nb\nc\n\nd\né\n')
+
+    def test_parse_markdown(self):
+        """ Links, dividers and text boxes from a Markdown link list, however it is chunked """
+        text = (
+            "# My Links\n\nAll about links\n\n"
+            "## Reading\n\n"
+            "- [Python \\[docs\\]](https://docs.python.org) - The manual\n"
+            "* [Flask](<https://flask.palletsprojects.com/en/2.0.x/(x)>)\n"
+            "1. https://example.com/bare\n"
+            "https://example.com/line\n\n"
+            "---\n\n"
+            "**Notes**\n\nFirst line\nsecond line\n\n<https://notes.com>\n\n"
+            "Loose text"
+        )
+        expected = [
+            {'type' : 'divider', 'title' : 'Reading'},
+            {'type' : 'link', 'title' : 'Python [docs]', 'url' : 'https://docs.python.org', 'description' : 'The manual'},
+            {'type' : 'link', 'title' : 'Flask', 'url' : 'https://flask.palletsprojects.com/en/2.0.x/(x)'},
+            {'type' : 'link', 'url' : 'https://example.com/bare'},
+            {'type' : 'link', 'url' : 'https://example.com/line'},
+            {'type' : 'divider', 'title' : ''},
+            {'type' : 'text_box', 'title' : 'Notes', 'description' : 'First line\nsecond line', 'url' : 'https://notes.com'},
+            {'type' : 'text_box', 'title' : '', 'description' : 'Loose text'}
+        ]
+        self.assertEqual(list(parse_markdown([text])), expected)
+        self.assertEqual(list(parse_markdown(chunked(text))), expected)
+
+    def test_parse_bookmarks(self):
+        """ Links, folders and descriptions from a browser's bookmarks export, however it is chunked """
+        text = (
+            '<!DOCTYPE NETSCAPE-Bookmark-file-1>\n<META HTTP-EQUIV="Content-Type" CONTENT="text/html; charset=UTF-8">\n'
+            '<TITLE>Bookmarks</TITLE>\n<H1>Bookmarks</H1>\n<DL><p>\n'
+            '    <DT><H3 ADD_DATE="1">Dev &amp; Tools</H3>\n    <DL><p>\n'
+            '        <DT><A HREF="https://github.com" ADD_DATE="1" ICON="data:image/png;base64,AAAA">GitHub</A>\n'
+            '        <DD>Where the\n code lives\n'
+            '        <DT><A HREF="javascript:alert(1)">Bookmarklet</A>\n'
+            '        <DT><A HREF="place:sort=8">Recently Visited</A>\n'
+            '    </DL><p>\n'
+            '    <DT><A HREF="https://untitled.com"></A>\n'
+            '</DL><p>\n'
+        )
+        expected = [
+            {'type' : 'divider', 'title' : 'Dev & Tools'},
+            {'type' : 'link', 'url' : 'https://github.com', 'title' : 'GitHub', 'description' : 'Where the code lives'},
+            {'type' : 'link', 'url' : 'https://untitled.com'}
+        ]
+        self.assertEqual(list(parse_bookmarks([text])), expected)
+        self.assertEqual(list(parse_bookmarks(chunked(text))), expected)
+
+    def test_helpers(self):
+        self.assertEqual(guess_format('Bookmarks.HTML'), 'html')
+        self.assertEqual(guess_format('links.md'), 'md')
+        self.assertEqual(guess_format(None), 'md')
+        self.assertEqual(list(batches(iter(range(5)), 2)), [[0, 1], [2, 3], [4]])
+
+        rows = [
+            {'type' : 'link', 'url' : 'http://a.com', 'description' : None, 'image' : None, 'scrape' : False},
+            {'type' : 'link', 'url' : 'http://b.com', 'description' : 'b', 'image' : 'b.png', 'scrape' : False},
+            {'type' : 'divider', 'url' : None, 'description' : None, 'image' : None, 'scrape' : False}
+        ]
+        mark_for_enrichment(rows)
+        self.assertEqual([row['scrape'] for row in rows], [True, False, False])
+
+        # Enrichment stops at the import's deadline
+        rows[0]['title'] = rows[0]['url']
+        with patch('imports.get_tags_batch', return_value=[{'url' : 'http://a.com', 'data' : {'title' : 'A'}}]) as batch:
+            enrich(rows, time.monotonic() - 1)
+            batch.assert_not_called()
+            enrich(rows, time.monotonic() + 5)
+            self.assertLessEqual(batch.call_args[1]['deadline'], 5)
+        self.assertEqual(rows[0]['title'], 'A')
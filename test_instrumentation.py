@@ -0,0 +1,67 @@
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, Entry, Repo
+
+# Set db to testing db prior to app import
+os.environ['DATABASE_URI'] = "postgresql:///link-test"
+
+from app import app
+
+db.drop_all()
+db.create_all()
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        Entry.query.delete()
+        Repo.query.delete()
+        db.session.add(Repo(access_key='123abc', pass_phrase='password', title='Test Repo'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_server_timing(self):
+        """ Responses report the request's query count and DB time """
+        with app.test_client() as client:
+            res = client.get('/api/repo/123abc')
+            timing = res.headers['Server-Timing']
+            self.assertRegex(timing, r'^db;dur=[\d.]+;desc="[1-9]\d* queries", app;dur=[\d.]+$')
+
+            res = client.get('/api/repo/123abc', headers={'If-None-Match' : res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+            self.assertIn('desc="1 queries"', res.headers['Server-Timing'])
+
+    def test_metrics(self):
+        """ /metrics serves per-endpoint request histograms and cache stats, behind METRICS_TOKEN when set """
+        with app.test_client() as client, patch('instrumentation.STATS_INTERVAL', 0):
+            client.get('/api/repo/123abc')
+            client.get('/api/repo/123abc')
+            res = client.get('/metrics')
+            self.assertEqual(res.status_code, 200)
+            self.assertTrue(res.content_type.startswith('text/plain'))
+            text = res.get_data(as_text=True)
+            self.assertRegex(text, r'linkbin_request_duration_seconds_count\{endpoint="api_repo_get",method="GET",status="200"\} [1-9]')
+            self.assertRegex(text, r'linkbin_request_db_queries_count\{endpoint="api_repo_get"\} [1-9]')
+            self.assertRegex(text, r'linkbin_cache\{cache="response",stat="hits"\} [1-9]')
+            self.assertIn('linkbin_visit_tracker{stat="pending"}', text)
+            self.assertIn('linkbin_http_pool{stat="connections"}', text)
+
+            app.config['METRICS_TOKEN'] = 'token'
+            try:
+                self.assertEqual(client.get('/metrics').status_code, 401)
+                res = client.get('/metrics', headers={'Authorization' : 'Bearer token'})
+                self.assertEqual(res.status_code, 200)
+            finally:
+                app.config['METRICS_TOKEN'] = None
+
+    def test_slow_query_log(self):
+        """ Statements over the threshold are logged with their endpoint """
+        with patch('instrumentation.SLOW_QUERY_MS', 1):
+            with self.assertLogs('linkbin.db', level='WARNING') as logs:
+                db.session.execute("SELECT pg_sleep(0.01)")
+        self.assertIn('in background: SELECT pg_sleep(0.01)', logs.output[0])
+
+    def test_statement_timeout(self):
+        """ Connections carry the configured statement_timeout """
+        self.assertEqual(db.session.execute("SHOW statement_timeout").scalar(), '15s')
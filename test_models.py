@@ -1,8 +1,16 @@
 import os
+import time
 from unittest import TestCase
-from sqlalchemy.exc import IntegrityError, DataError
-from models import db, Entry, Repo, EntryType
-from datetime import datetime
+from unittest.mock import patch
+from sqlalchemy import event, tuple_
+from alembic.autogenerate import compare_metadata
+from alembic.migration import MigrationContext
+from flask_migrate import stamp, upgrade
+from sqlalchemy.exc import IntegrityError, DataError, OperationalError
+from models import db, Entry, Repo, EntryType, ScrapeCache, ScrapeJob, JobStatus
+import hashing
+from utils import generate_access_key, ACCESS_KEY_LENGTH, ACCESS_KEY_ALPHABET
+from datetime import datetime, timedelta
 
 # Set db to testing db prior to app import
 os.environ['DATABASE_URI'] = "postgresql:///link-test"
@@ -98,6 +106,27 @@ class RepoModelTestCase(TestCase):
         self.assertEqual(repo1.last_visited, today)
         self.assertEqual(repo2.last_visited, today)
     
+    def test_insert_new_method(self):
+        """insert_new must draw another access key only when one is taken"""
+        db.session.add(Repo(access_key='taken', pass_phrase='pw'))
+        db.session.commit()
+
+        with patch('models.generate_access_key', side_effect=['taken', 'fresh']):
+            created = Repo.insert_new(pass_phrase='pw', title='title a')
+        db.session.commit()
+        self.assertEqual(created.access_key, 'fresh')
+        self.assertTrue(Repo.authenticate('fresh', 'pw'))
+        self.assertEqual(Repo.query.get('fresh').title, 'title a')
+        self.assertEqual(Repo.query.get('fresh').is_private, False)
+
+        with patch('models.generate_access_key', return_value='taken'):
+            self.assertIsNone(Repo.insert_new(pass_phrase='pw', attempts=3))
+        db.session.rollback()
+
+        key = generate_access_key()
+        self.assertEqual(len(key), ACCESS_KEY_LENGTH)
+        self.assertTrue(set(key) <= set(ACCESS_KEY_ALPHABET))
+    
     def test_auth_method(self):
         """Authenticate method must return true if plaintext passphrase matches hashed passphrase"""
 
@@ -117,6 +146,13 @@ class RepoModelTestCase(TestCase):
 
         self.assertFalse(Repo.authenticate('hjs09rjthsg', 'pw')) # return false on non-existant repo
         self.assertFalse(Repo.authenticate(key, repo.pass_phrase)) # should not authenticate on passing in hash
+
+        # Hashes made at an outdated cost are replaced on login
+        repo.pass_phrase = hashing._hash('pw', 4)
+        db.session.commit()
+        self.assertTrue(Repo.authenticate(key, 'pw'))
+        self.assertEqual(hashing.hash_rounds(Repo.query.get(key).pass_phrase), hashing.LOG_ROUNDS)
+        self.assertTrue(Repo.authenticate(key, 'pw'))
     
     def test_json_serialize(self):
         """JSON method must return a python dictionary containing repo info"""
@@ -133,6 +169,21 @@ class RepoModelTestCase(TestCase):
         self.assertEqual(str(repo.last_visited), repo_json['last_visited'])
         self.assertEqual(len(repo.entries), len(repo_json['entries']))
 
+    def test_json_entries_order(self):
+        """Serialized entries must come back ordered by sequence"""
+        db.session.add_all([
+            Entry(title='second', sequence=1, repo_access_key='123abc'),
+            Entry(title='third', sequence=2, repo_access_key='123abc'),
+            Entry(title='first', sequence=0, repo_access_key='123abc')
+        ])
+        db.session.commit()
+
+        repo = Repo.query.get('123abc')
+        titles = [entry['title'] for entry in repo.to_json()['entries']]
+        self.assertEqual(titles, ['first', 'second', 'third'])
+        self.assertEqual([entry.title for entry in repo.entries], titles)
+        self.assertEqual(repo.to_json()['entries'][0], Entry.query.filter_by(title='first').one().to_json())
+
 class EntryModelTestCase(TestCase):
     def setUp(self):
         # Clean old data
@@ -154,6 +205,20 @@ class EntryModelTestCase(TestCase):
         # Clean failed transactions
         db.session.rollback()
     
+    def test_editable_rows_lock(self):
+        """Rows loaded for a bulk update are locked, so other writers wait instead of being overwritten"""
+        rows = Entry.editable_rows('123abc', [self.entry_id])
+        self.assertEqual(rows[self.entry_id]['title'], 'entry title')
+
+        with db.engine.connect() as conn:
+            conn.execute(db.text("SET lock_timeout = '100ms'"))
+            with self.assertRaises(OperationalError):
+                conn.execute(db.text("UPDATE entries SET description = 'scraped' WHERE id = :id"), id=self.entry_id)
+
+        Entry.bulk_update(rows, [{'id' : self.entry_id, 'title' : 'changed'}])
+        db.session.commit()
+        self.assertEqual(Entry.query.get(self.entry_id).title, 'changed')
+
     def test_fields(self):
         # Entry Type defaults to 'link'
         self.assertEqual(
@@ -208,3 +273,162 @@ class EntryModelTestCase(TestCase):
         )
 
 
+
+class IndexTestCase(TestCase):
+    def explain(self, query):
+        """ Query plan for a select, with sequential and bitmap scans discouraged so the planner picks any usable index
+        (and any ordering it provides) even on the test database's tiny tables """
+        sql = str(query.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds' : True}))
+        with db.engine.begin() as conn:
+            conn.execute(db.text('SET LOCAL enable_seqscan = off'))
+            conn.execute(db.text('SET LOCAL enable_bitmapscan = off'))
+            return '\n'.join(row[0] for row in conn.execute(db.text('EXPLAIN ' + sql)))
+
+    def test_repo_entries_index(self):
+        """Loading a repo's entries in sequence order should be served by ix_entries_repo_sequence, with no sort"""
+        query = db.select([Entry.id, Entry.title]).where(Entry.repo_access_key == '123abc').order_by(Entry.sequence, Entry.id)
+        plan = self.explain(query)
+        self.assertIn('ix_entries_repo_sequence', plan)
+        self.assertNotIn('Sort', plan)
+
+    def test_repo_entries_page_index(self):
+        """A page of entries after a cursor should be a range of ix_entries_repo_sequence, not a filter over the repo"""
+        query = db.select([Entry.id]).where(Entry.repo_access_key == '123abc').where(
+            tuple_(Entry.sequence, Entry.id) > (5, 10)
+        ).order_by(Entry.sequence, Entry.id).limit(100)
+        plan = self.explain(query)
+        self.assertIn('ix_entries_repo_sequence', plan)
+        self.assertIn('Index Cond: ((repo_access_key = ', plan)
+        self.assertNotIn('Filter', plan)
+
+    def test_scrape_job_indexes(self):
+        """Finding an entry's scrape job and claiming the next job should both use indexes"""
+        plan = self.explain(db.select([Entry.id]).where(Entry.scrape_job_id == 1))
+        self.assertIn('ix_entries_scrape_job_id', plan)
+
+        query = db.select([ScrapeJob.id]).where(ScrapeJob.status.in_([JobStatus.pending, JobStatus.running])).order_by(ScrapeJob.id).limit(1)
+        self.assertIn('ix_scrape_jobs_queue', self.explain(query))
+
+# The schema db.create_all() built before migrations were introduced
+BASELINE_SCHEMA = """
+CREATE TYPE entrytype AS ENUM ('link', 'text_box', 'divider');
+CREATE TABLE repos (
+    access_key TEXT NOT NULL PRIMARY KEY,
+    pass_phrase TEXT NOT NULL,
+    title VARCHAR(50),
+    description VARCHAR(300),
+    is_private BOOLEAN NOT NULL,
+    last_visited DATE NOT NULL
+);
+CREATE TABLE entries (
+    id SERIAL NOT NULL PRIMARY KEY,
+    title TEXT NOT NULL,
+    description TEXT,
+    image TEXT,
+    url TEXT,
+    type entrytype NOT NULL,
+    rating INTEGER,
+    sequence INTEGER,
+    repo_access_key TEXT NOT NULL REFERENCES repos (access_key) ON DELETE CASCADE
+);
+INSERT INTO repos VALUES ('123abc', 'password', 'Old Repo', NULL, false, '2021-01-01');
+INSERT INTO entries (title, url, type, sequence, repo_access_key) VALUES ('Old', 'http://old.com', 'link', 0, '123abc');
+"""
+
+class MigrationTestCase(TestCase):
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_upgrade_baseline_database(self):
+        """A database from before migrations, stamped 0001 as the README says, upgrades to exactly the models' schema"""
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as conn:
+            conn.execute(db.text('DROP TABLE IF EXISTS alembic_version'))
+            conn.execute(db.text(BASELINE_SCHEMA))
+
+        with app.app_context():
+            stamp(revision='0001')
+            upgrade()
+
+        with db.engine.connect() as conn:
+            self.assertEqual(compare_metadata(MigrationContext.configure(conn), db.metadata), [])
+        self.assertEqual(Entry.query.one().title, 'Old')
+        Entry.query.delete()
+        Repo.query.delete()
+        db.session.commit()
+
+class ScrapeCacheModelTestCase(TestCase):
+    def setUp(self):
+        ScrapeCache.query.delete()
+        db.session.commit()
+
+    def test_store(self):
+        """ ScrapeCache should round-trip metadata and hide expired rows """
+        ScrapeCache.save('http://example.com', {'title' : 'Example'}, time.time() + 60)
+        value, expires_at = ScrapeCache.fetch('http://example.com')
+        self.assertEqual(value, {'title' : 'Example'})
+        self.assertGreater(expires_at, time.time())
+
+        # Saving again overwrites
+        ScrapeCache.save('http://example.com', {'title' : 'Changed'}, time.time() - 1)
+        self.assertIsNone(ScrapeCache.fetch('http://example.com'))
+
+        ScrapeCache.discard('http://example.com')
+        self.assertEqual(ScrapeCache.query.count(), 0)
+
+    def test_purge(self):
+        """ ScrapeCache.purge should delete expired rows up to the limit and keep fresh ones """
+        for i in range(3):
+            ScrapeCache.save(f"http://expired.com/{i}", {'title' : 'Old'}, time.time() - 60)
+        ScrapeCache.save('http://fresh.com', {'title' : 'New'}, time.time() + 60)
+
+        self.assertEqual(ScrapeCache.purge(2), 2)
+        self.assertEqual(ScrapeCache.purge(2), 1)
+        db.session.commit()
+        self.assertEqual([row.url for row in ScrapeCache.query.all()], ['http://fresh.com'])
+
+class ScrapeJobModelTestCase(TestCase):
+    def setUp(self):
+        Entry.query.delete()
+        ScrapeJob.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_enqueue_finished_race(self):
+        """ A job that finishes between enqueue_many's INSERT and SELECT should be replaced by a new one """
+        old_id = ScrapeJob.enqueue('http://example.com').id
+        db.session.commit()
+
+        finished = []
+        def finish_job(conn, cursor, statement, parameters, context, executemany):
+            if not finished and statement.startswith('SELECT') and 'scrape_jobs' in statement:
+                finished.append(True)
+                with db.engine.begin() as other:
+                    other.execute(ScrapeJob.__table__.update().values(status=JobStatus.done.name))
+
+        event.listen(db.engine, 'before_cursor_execute', finish_job)
+        try:
+            jobs = ScrapeJob.enqueue_many(['http://example.com'])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', finish_job)
+        self.assertTrue(finished)
+        self.assertNotEqual(jobs['http://example.com'], old_id)
+        self.assertEqual(ScrapeJob.query.get(jobs['http://example.com']).status, JobStatus.pending)
+
+    def test_purge(self):
+        """ ScrapeJob.purge should only delete finished jobs last updated before the cutoff """
+        now = datetime.utcnow()
+        db.session.add_all([
+            ScrapeJob(url='http://old.com/done', status=JobStatus.done, updated_at=now - timedelta(days=2)),
+            ScrapeJob(url='http://old.com/failed', status=JobStatus.failed, updated_at=now - timedelta(days=2)),
+            ScrapeJob(url='http://old.com/pending', status=JobStatus.pending, updated_at=now - timedelta(days=2)),
+            ScrapeJob(url='http://new.com/done', status=JobStatus.done, updated_at=now),
+        ])
+        db.session.commit()
+
+        self.assertEqual(ScrapeJob.purge(now - timedelta(days=1), 10), 2)
+        db.session.commit()
+        self.assertEqual(sorted(job.url for job in ScrapeJob.query.all()), ['http://new.com/done', 'http://old.com/pending'])
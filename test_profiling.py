@@ -0,0 +1,55 @@
+import os
+import pstats
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from models import db, Entry, Repo
+
+# Set db to testing db prior to app import
+os.environ['DATABASE_URI'] = "postgresql:///link-test"
+
+from app import app
+
+db.drop_all()
+db.create_all()
+
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        Entry.query.delete()
+        Repo.query.delete()
+        db.session.add(Repo(access_key='123abc', pass_phrase='password', title='Test Repo'))
+        db.session.add(Entry(title='entry title', url='http://url.com', repo_access_key='123abc'))
+        db.session.commit()
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.dir.cleanup()
+
+    def test_sampled_endpoints(self):
+        """ Requests to the chosen endpoints are profiled at the sample rate, others never """
+        with patch('profiling.ENDPOINTS', {'api_repo_get'}), patch('profiling.DIR', self.dir.name):
+            with app.test_client() as client:
+                with patch('profiling.SAMPLE_RATE', 0):
+                    res = client.get('/api/repo/123abc')
+                    self.assertNotIn('X-Profile-File', res.headers)
+                with patch('profiling.SAMPLE_RATE', 1):
+                    res = client.get('/api/repo/123abc/entries')
+                    self.assertNotIn('X-Profile-File', res.headers)
+                    res = client.get('/api/repo/123abc')
+
+        name = res.headers['X-Profile-File']
+        self.assertTrue(name.startswith('api_repo_get-'))
+        self.assertEqual(os.listdir(self.dir.name), [name])
+        stats = pstats.Stats(os.path.join(self.dir.name, name))
+        self.assertIn('api_repo_get', {function for (_, _, function) in stats.stats})
+
+    def test_token_header(self):
+        """ Any request can be profiled on demand with the admin token """
+        with patch('profiling.TOKEN', 'secret'), patch('profiling.DIR', self.dir.name):
+            with app.test_client() as client:
+                res = client.get('/api/repo/123abc', headers={'X-Profile' : 'wrong'})
+                self.assertNotIn('X-Profile-File', res.headers)
+                res = client.get('/api/repo/123abc/entries', headers={'X-Profile' : 'secret'})
+                self.assertTrue(res.headers['X-Profile-File'].startswith('api_repo_entries-'))
+        self.assertEqual(len(os.listdir(self.dir.name)), 1)
@@ -0,0 +1,213 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase
+from unittest.mock import patch
+from cache import TieredCache
+from scrape import parse_HTML, MetaTagParser, normalize_url, scrape_tags, pool_stats, get_tags_batch
+
+class PageHandler(BaseHTTPRequestHandler):
+    """ Serves the same complete page on every path, over keep-alive connections """
+    protocol_version = 'HTTP/1.1'
+    page = (b'<html><head><meta property="og:title" content="Local"><meta property="og:description" content="Page">'
+        b'<meta property="og:image" content="i.png"><meta property="og:url" content="/"></head><body></body></html>')
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message(self, *args):
+        pass
+
+class SlowPageHandler(PageHandler):
+    """ Takes a while over every page """
+    def do_GET(self):
+        time.sleep(0.4)
+        super().do_GET()
+
+class StreamHandler(BaseHTTPRequestHandler):
+    """ Pages whose bodies are slow, trickled or large, each served without a length on a connection closed after it """
+    def do_GET(self):
+        content_type = {'/image' : 'image/png', '/text' : 'text/plain'}.get(self.path, 'text/html')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        try:
+            if self.path == '/large':
+                self.wfile.write(b'<html><head><meta property="og:title" content="Large">' + b' ' * 64 * 1024)
+                self.wfile.write(b'<meta property="og:description" content="Too far"></head>')
+            elif self.path == '/trickle':
+                self.wfile.write(b'<html><head><meta property="og:title" content="Trickle">')
+                for i in range(50):
+                    time.sleep(0.1)
+                    self.wfile.write(b' ')
+                    self.wfile.flush()
+            else:
+                # The head, if any, arrives at once, the rest of the page much later
+                if content_type == 'text/html':
+                    self.wfile.write(b'<html><head><meta property="og:title" content="Head"></head>')
+                    self.wfile.flush()
+                time.sleep(2)
+                self.wfile.write(b'<body>' + b' ' * 64 * 1024 + b'</body></html>')
+        except OSError:
+            # The scraper hung up, as it should
+            pass
+
+    def log_message(self, *args):
+        pass
+
+class ParseHTMLTestCase(TestCase):
+    def test_opengraph(self):
+        """ OpenGraph tags are found regardless of quoting or attribute order """
+        page = """<html><head>
+            <meta property="og:title" content="Double">
+            <meta content='Single &amp; quoted' property='og:description'/>
+            <meta property=og:url content=http://example.com>
+            <META PROPERTY="og:image" CONTENT="image.png" />
+            <meta property="og:site_name" content="">
+        </head><body></body></html>"""
+        tags = parse_HTML(page)
+
+        self.assertEqual(tags['title'], 'Double')
+        self.assertEqual(tags['description'], 'Single & quoted')
+        self.assertEqual(tags['url'], 'http://example.com')
+        self.assertEqual(tags['image'], 'image.png')
+        # Empty tags are ignored
+        self.assertNotIn('site_name', tags)
+
+    def test_fallbacks(self):
+        """ Title and description fall back to the <title> tag and meta description, or empty strings """
+        page = """<html><head><Title> The Title </Title>
+            <meta name="Description" content="The description"></head></html>"""
+        tags = parse_HTML(page)
+        self.assertEqual(tags['title'], 'The Title')
+        self.assertEqual(tags['description'], 'The description')
+
+        tags = parse_HTML('<html><head></head></html>')
+        self.assertEqual(tags, {'title' : '', 'description' : ''})
+
+    def test_stops_at_body(self):
+        """ Meta tags outside of the head are not scanned """
+        page = '<head><title>Head</title></head><body><meta property="og:title" content="Body"></body>'
+        self.assertEqual(parse_HTML(page)['title'], 'Head')
+
+    def test_incremental(self):
+        """ Tags split across fed chunks should still be found """
+        page = '<html><head><title>Split title</title><meta property="og:image" content="a.png"></head><body>'
+        for size in (1, 3, 7):
+            parser = MetaTagParser()
+            for i in range(0, len(page), size):
+                parser.feed(page[i:i + size])
+            self.assertTrue(parser.done)
+            self.assertEqual(parser.tags()['title'], 'Split title')
+            self.assertEqual(parser.tags()['image'], 'a.png')
+
+class NormalizeURLTestCase(TestCase):
+    def test_normalize(self):
+        self.assertEqual(normalize_url('HTTP://Example.COM/Path?q=1#frag'), 'http://example.com/Path?q=1')
+
+class PooledFetchTestCase(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """ Repeated scrapes of one host should reuse a single pooled connection """
+        self.assertEqual(scrape_tags(self.base + '/a')['title'], 'Local')
+        self.assertEqual(scrape_tags(self.base + '/b')['title'], 'Local')
+
+        stats = pool_stats()[self.base]
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['requests'], 2)
+
+    def test_typed_url(self):
+        """ A URL typed without a scheme counts as the page's url, so a page with every other tag skips opengraph.io """
+        PageHandler.page = PageHandler.page.replace(b'<meta property="og:url" content="/">', b'')
+        try:
+            with patch('scrape.opengraphIO_scrape', return_value={}) as opengraph:
+                self.assertEqual(scrape_tags(self.base + '/c', typed_url=True)['url'], self.base + '/c')
+                opengraph.assert_not_called()
+                scrape_tags(self.base + '/d')
+                opengraph.assert_called_once()
+        finally:
+            PageHandler.page = PageHandler.page.replace(b'</head>', b'<meta property="og:url" content="/"></head>')
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        self.servers = [ThreadingHTTPServer(('127.0.0.1', 0), handler) for handler in (SlowPageHandler, PageHandler)]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.slow, self.fast = (f"http://127.0.0.1:{server.server_address[1]}" for server in self.servers)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_host_queue(self):
+        """ URLs waiting on their host's limit don't take up pool threads, so other hosts still get scraped """
+        pool = ThreadPoolExecutor(max_workers=2)
+        with patch('scrape.batch_pool', pool), patch('scrape.BATCH_PER_HOST', 1), patch('scrape.tag_cache', TieredCache()):
+            urls = [f"{self.slow}/{i}" for i in range(4)] + [self.fast + '/']
+            results = get_tags_batch(urls, deadline=0.6)
+        pool.shutdown()
+
+        self.assertEqual(results[0]['data']['title'], 'Local')
+        self.assertEqual(results[4]['data']['title'], 'Local')
+        self.assertEqual([result.get('error') for result in results[1:4]], ['Timed out'] * 3)
+
+class StreamedFetchTestCase(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StreamHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        patcher = patch('scrape.opengraphIO_scrape', return_value={})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def timed_scrape(self, path):
+        start = time.monotonic()
+        tags = scrape_tags(self.base + path)
+        return tags, time.monotonic() - start
+
+    def test_skips_bodies(self):
+        """ Images and non-HTML are answered from their headers, without waiting on their bodies """
+        tags, elapsed = self.timed_scrape('/image')
+        self.assertEqual(tags, {'title' : self.base + '/image', 'image' : self.base + '/image', 'url' : self.base + '/image'})
+        self.assertLess(elapsed, 1)
+        tags, elapsed = self.timed_scrape('/text')
+        self.assertEqual(tags, {'title' : self.base + '/text'})
+        self.assertLess(elapsed, 1)
+
+    def test_stops_at_head(self):
+        """ Reading stops at the end of the <head>, without waiting for the rest of the page """
+        tags, elapsed = self.timed_scrape('/head')
+        self.assertEqual(tags['title'], 'Head')
+        self.assertLess(elapsed, 1)
+
+    def test_max_bytes(self):
+        """ Nothing past MAX_BYTES is parsed """
+        with patch('scrape.MAX_BYTES', 16 * 1024):
+            tags, elapsed = self.timed_scrape('/large')
+        self.assertEqual(tags['title'], 'Large')
+        self.assertEqual(tags['description'], '')
+
+    def test_total_timeout(self):
+        """ A page trickling in a byte at a time is cut off at TOTAL_TIMEOUT, even though no single read times out """
+        with patch('scrape.TOTAL_TIMEOUT', 0.5):
+            tags, elapsed = self.timed_scrape('/trickle')
+        self.assertEqual(tags['title'], 'Trickle')
+        self.assertLess(elapsed, 1.5)
@@ -0,0 +1,69 @@
+import os
+from unittest import TestCase
+from datetime import date, timedelta
+from models import db, Entry, Repo
+from visits import VisitTracker, visit_tracker
+
+# Set db to testing db prior to app import
+os.environ['DATABASE_URI'] = "postgresql:///link-test"
+
+from app import app
+
+db.drop_all()
+db.create_all()
+
+class VisitTrackerTestCase(TestCase):
+    def setUp(self):
+        # Clean old data
+        Entry.query.delete()
+        Repo.query.delete()
+
+        last_week = date.today() - timedelta(days=7)
+        db.session.add_all([
+            Repo(access_key='123abc', pass_phrase='password', last_visited=last_week),
+            Repo(access_key='456def', pass_phrase='password', last_visited=last_week),
+            Repo(access_key='today', pass_phrase='password')
+        ])
+        db.session.commit()
+        self.tracker = VisitTracker(flush_interval=3600)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_flush(self):
+        """ Repeated visits coalesce into a single write per repo, made only on flush """
+        for i in range(5):
+            self.tracker.record('123abc', Repo.query.get('123abc').last_visited)
+        self.tracker.record('456def', Repo.query.get('456def').last_visited)
+        self.assertEqual(self.tracker.pending(), 2)
+        db.session.rollback()
+        self.assertLess(Repo.query.get('123abc').last_visited, date.today())
+
+        self.assertEqual(self.tracker.flush(), 2)
+        db.session.rollback()
+        self.assertEqual(Repo.query.get('123abc').last_visited, date.today())
+        self.assertEqual(Repo.query.get('456def').last_visited, date.today())
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_once_a_day(self):
+        """ Repos already stamped today aren't written again """
+        self.tracker.record('today', Repo.query.get('today').last_visited)
+        self.assertEqual(self.tracker.pending(), 0)
+
+        # Nor are repos another process stamped since they were loaded
+        self.tracker.record('123abc', date.today() - timedelta(days=7))
+        Repo.query.get('123abc').last_visited = date.today()
+        db.session.commit()
+        self.assertEqual(self.tracker.flush(), 0)
+
+    def test_repo_view(self):
+        """ Viewing a repo records a visit instead of writing it """
+        with app.test_client() as client:
+            res = client.get('/repo/123abc')
+            self.assertEqual(res.status_code, 200)
+        db.session.rollback()
+        self.assertLess(Repo.query.get('123abc').last_visited, date.today())
+
+        visit_tracker.flush()
+        db.session.rollback()
+        self.assertEqual(Repo.query.get('123abc').last_visited, date.today())
@@ -1,35 +1,12 @@
-from random import random, choice, seed
-from datetime import datetime
+import os
+import secrets
+import string
 
-## Probably placebo, but adding some gibberish into datetime for the RNG seed seems to 
-## reduce patterns of double characters (i.e. two of the same chars in a row) in key generation 
-def generate_seed():
-    chars = "abcdefghijklmnopqrstuwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&**()_+-=[];:'<>,.?"
-    num = random()
-    seed = str(datetime.now())
-    for x in str(num):
-        seed = seed + x + choice(chars)
-    
-    return seed
+# 10 characters of 62 is ~59.5 bits, so even millions of repos are unlikely to ever see a collision
+ACCESS_KEY_LENGTH = int(os.environ.get('ACCESS_KEY_LENGTH', 10))
+ACCESS_KEY_ALPHABET = os.environ.get('ACCESS_KEY_ALPHABET', string.ascii_letters + string.digits)
 
-def generate_access_key():
-    """Randomly generates a 10 character string from a selection of upper and lowercase letters, and digits."""
-    key = ""
-    alphabet = "abcdefghijklmnopqrstuwxyz1234567890"
-    seed(generate_seed())
-    for i in range(0, 10):
-        char = choice(alphabet) if random() > 0.5 else choice(alphabet).upper()
-        key = key + char
-    return key
-
-def test_keygen(passes):
-    results = set()
-    count = 0
-    for i in range(0,passes):
-        key = generate_access_key()
-        if key in results:
-            print(f"Duplicate: {key}")
-            count += 1
-        else:
-            results.add(key)
-    print(f"Detected {count} duplicates over {passes} keys.")
\ No newline at end of file
+def generate_access_key(length=ACCESS_KEY_LENGTH, alphabet=ACCESS_KEY_ALPHABET):
+    """Generates a random access key from the operating system's cryptographically secure source. Unlike the random
+    module, this needs no seeding, so concurrent calls can't repeat each other's keys."""
+    return ''.join(secrets.choice(alphabet) for _ in range(length))
@@ -0,0 +1,91 @@
+import atexit
+import os
+import threading
+import time
+from datetime import date
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from models import db, Repo
+
+# Longest a visit waits in memory before being written, and so the most visit history a crash can lose
+FLUSH_INTERVAL = float(os.environ.get('VISIT_FLUSH_INTERVAL', 60))
+
+class VisitTracker:
+    """ Collects repo visits in memory and writes them to repos.last_visited in bulk, every flush_interval seconds from a
+    background thread and once more at exit. As last_visited is a date, a repo needs at most one write a day: visits to
+    a repo already stamped today are dropped, and repeat visits between flushes coalesce into one pending update. """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self.flushes = 0
+        self.writes = 0
+        atexit.register(self.flush)
+
+    def record(self, access_key, last_visited):
+        """ Notes a visit to a repo, given the last_visited it was loaded with. """
+        today = date.today()
+        if last_visited >= today:
+            return
+        with self._lock:
+            self._pending[access_key] = today
+            # Started on first use, and again in forked workers, which don't inherit the parent's threads
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """ Writes the pending visits with one UPDATE per distinct day (normally just today), returning the number of repos
+        updated. Repos another process already stamped are skipped by the WHERE clause, and those row-locked by an edit
+        in progress are skipped rather than waited on; either way their next visit is recorded again. """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        days = {}
+        for access_key, day in pending.items():
+            days.setdefault(day, []).append(access_key)
+
+        table = Repo.__table__
+        updated = 0
+        try:
+            with db.engine.begin() as conn:
+                for day, access_keys in days.items():
+                    stale = select(table.c.access_key).where(
+                        table.c.access_key.in_(access_keys), table.c.last_visited < day
+                    ).with_for_update(skip_locked=True)
+                    updated += conn.execute(
+                        table.update().where(table.c.access_key.in_(stale)).values(last_visited=day)
+                    ).rowcount
+        except SQLAlchemyError:
+            # Kept for the next flush, unless a newer visit was recorded meanwhile
+            with self._lock:
+                for access_key, day in pending.items():
+                    self._pending.setdefault(access_key, day)
+            return 0
+
+        self.flushes += 1
+        self.writes += updated
+        return updated
+
+    def stats(self):
+        return {
+            "pending" : self.pending(),
+            "flushes" : self.flushes,
+            "writes" : self.writes
+        }
+
+
+visit_tracker = VisitTracker()
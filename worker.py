@@ -0,0 +1,59 @@
+""" Background worker that resolves queued scrape jobs (see models.ScrapeJob), so web requests never wait on
+third-party sites. Run alongside the web process: python worker.py
+When WORKER_METRICS_PORT is set, the worker's own scrape metrics are served on that port for Prometheus to scrape. """
+import logging
+import os
+import threading
+import time
+from prometheus_client import start_http_server
+from app import app
+import metrics
+from models import db, ScrapeJob
+from scrape import get_tags, pool_stats
+
+THREADS = int(os.environ.get('SCRAPE_WORKER_THREADS', 4))
+POLL_INTERVAL = float(os.environ.get('SCRAPE_WORKER_POLL', 1))
+METRICS_PORT = os.environ.get('WORKER_METRICS_PORT')
+
+logger = logging.getLogger('linkbin.worker')
+
+def run_once():
+    """ Claims and resolves a single job. Returns False if the queue was empty. """
+    job = ScrapeJob.claim()
+    if job is None:
+        return False
+
+    try:
+        # Jobs are queued by their (already decoded) cache key
+        tags = get_tags(job.url, quoted=False)
+    except Exception:
+        logger.exception("Scrape job %s failed", job.id)
+        db.session.rollback()
+        job.fail()
+    else:
+        job.complete(tags)
+    metrics.update_stats({}, http_pools=pool_stats())
+    return True
+
+def work():
+    with app.app_context():
+        while True:
+            try:
+                found = run_once()
+            except Exception:
+                logger.exception("Scrape worker error")
+                db.session.rollback()
+                found = False
+            if not found:
+                time.sleep(POLL_INTERVAL)
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s')
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT))
+        logger.info("Serving metrics on port %s", METRICS_PORT)
+    threads = [threading.Thread(target=work, daemon=True) for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()